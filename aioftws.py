@@ -5,25 +5,557 @@
 
 import argparse
 import asyncio
+import base64
+import binascii
+import bisect
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import secrets
+import shutil
+import signal
+import stat
+import tempfile
+import threading
+import time
+import traceback
 import urllib.parse
-from aiohttp import web
+import zipfile
+import zlib
+from aiohttp import ClientSession, ClientError, FormData, payload, web
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import ipaddress
 from pathlib import Path
 import netifaces
-from typing import List
+from typing import BinaryIO, Deque, Dict, FrozenSet, List, Optional, Tuple
 from datetime import datetime
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Default maximum size of the directory listings kept in memory, in MiB
+LISTING_CACHE_MIB = 64
+# Listings of directories modified less than this many seconds ago are not cached, since a change
+# within the same mtime granularity of the file system would not be noticed
+LISTING_RACY_SECONDS = 2
+# Approximate memory used by a cached listing entry besides its name, in bytes
+LISTING_ENTRY_BYTES = 150
+# Number of entries rendered and written at once when streaming a listing
+LISTING_BATCH = 1000
+# Default and maximum number of entries in a page of the JSON listing
+JSON_PAGE_LIMIT = 1000
+JSON_MAX_PAGE_LIMIT = 100000
+# Sort orders of the JSON listing, by the index of the sort key in a StatEntry
+JSON_SORT_FIELDS = {'name': 0, 'size': 2, 'mtime': 3}
+# Size of the reads of files added to a ZIP download, and of the writes of the archive to the client
+ZIP_CHUNK_SIZE = 2**20
+# Compression methods of ZIP downloads
+ZIP_COMPRESSION = {'store': zipfile.ZIP_STORED, 'deflate': zipfile.ZIP_DEFLATED}
+# Size of the reads of uploaded files from the request
+UPLOAD_CHUNK_SIZE = 2**20
+# Number of chunks of an uploaded file that may wait to be written before reading the request pauses
+UPLOAD_QUEUE_DEPTH = 8
+# Uploaded files are preallocated once they reach this size, so small files are never preallocated
+# with the size bound of a whole request
+UPLOAD_PREALLOCATE_BYTES = 64 * 2**20
+# When uploaded files are flushed to storage: never, when the file is complete, or after each chunk
+FSYNC_POLICIES = ['none', 'close', 'chunk']
+# Directory of the upload directory in which the sessions of resumable uploads are kept
+UPLOAD_SESSIONS_DIR = '.upload_sessions'
+# Largest chunk of a resumable upload accepted in one request
+UPLOAD_MAX_CHUNK = 256 * 2**20
+# Sessions of resumable uploads that received nothing for this many seconds are deleted
+UPLOAD_SESSION_EXPIRY = 24 * 3600
+# Default Cache-Control of each mode. Tree mode responses may be stored, but are revalidated with
+# their ETag or Last-Modified on each use.
+CACHE_CONTROL = {'tree': 'no-cache', 'upload': 'no-store, no-cache, must-revalidate, max-age=0'}
+# Number of parallel Range requests of the download client, and the smallest part each one fetches
+FETCH_CONNECTIONS = 4
+FETCH_MIN_PART = 4 * 2**20
+# Number of times the download client retries a part before giving up
+FETCH_RETRIES = 5
+# Size of the reads of downloaded data from the response
+FETCH_CHUNK_SIZE = 2**20
+# Content encodings in order of preference, with the suffix of their files in the compression cache
+COMPRESSION_SUFFIXES = {'zstd': 'zst', 'gzip': 'gz'}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# Files smaller than this are never compressed, and compressed files smaller than this are not
+# worth keeping in the compression cache
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_CACHE_MIN_BYTES = 2**20
+# Default maximum size of the compression cache, in MiB
+COMPRESS_CACHE_MIB = 1024
+# Lock file of the compression cache, held while evicting
+COMPRESS_CACHE_LOCK_NAME = 'lock'
+# Workers that die sooner than this many seconds after starting are restarted only after this delay,
+# so a worker failing on startup does not fork in a tight loop
+WORKER_RESTART_DELAY = 1
+# Workers are no longer restarted, and the server exits, once a worker died this many times in a row
+# sooner than WORKER_RESTART_DELAY after starting, which means it cannot start at all
+WORKER_MAX_FAST_FAILURES = 5
+# Types worth compressing besides text/*, +json and +xml types
+COMPRESSIBLE_TYPES = {'application/javascript', 'application/json', 'application/xml', 'application/x-ndjson', 'image/svg+xml'}
+# Logs have no registered type
+mimetypes.add_type('text/plain', '.log')
+
+cache_control_key = web.AppKey('cache_control', str)
+
 async def on_prepare(request: web.Request, response: web.StreamResponse) -> None:
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
+    cache_control: str = request.app[cache_control_key]
+    response.headers['Cache-Control'] = cache_control
+    if 'no-store' in cache_control:
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
 
 def get_ip_port(request: web.Request) -> (str, int):
     info = request.transport.get_extra_info('peername')
     return info[:2]
 
+# Entry of a directory listing: name and whether it is a directory
+ListingEntry = Tuple[str, bool]
+# Entry of a directory listing with its current size and mtime in nanoseconds
+StatEntry = Tuple[str, bool, int, int]
+
+class DirectoryListing:
+    # Directories and files of a directory, sorted by name. Entries of other types, and broken
+    # symlinks, are left out. Only names and types are kept, since they change the mtime of the
+    # directory when they change, unlike the sizes and mtimes of the entries.
+    def __init__(self, entries: List[ListingEntry]) -> None:
+        self.entries: List[ListingEntry] = entries
+        self.nbytes: int = sum(len(entry[0]) + LISTING_ENTRY_BYTES for entry in entries)
+
+def scan_directory(full_path: Path) -> DirectoryListing:
+    # Lists the directory with a single scandir pass. DirEntry.is_dir() and is_file() only stat
+    # symlinks, since the type of other entries is known from the directory itself.
+    entries: List[ListingEntry] = []
+    with os.scandir(full_path) as dir_entries:
+        for dir_entry in dir_entries:
+            try:
+                if dir_entry.is_dir():
+                    entries.append((dir_entry.name, True))
+                elif dir_entry.is_file():
+                    entries.append((dir_entry.name, False))
+            except OSError:
+                continue
+    entries.sort()
+    return DirectoryListing(entries)
+
+def stat_entries(full_path: Path, entries: List[ListingEntry]) -> List[StatEntry]:
+    # Adds the current size and mtime of the entries, leaving out those removed since the listing
+    result: List[StatEntry] = []
+    for name, is_dir in entries:
+        try:
+            entry_stat: os.stat_result = os.stat(full_path / name)
+        except OSError:
+            continue
+        result.append((name, is_dir, entry_stat.st_size, entry_stat.st_mtime_ns))
+    return result
+
+class ListingCache:
+    # Directory listings by resolved directory, least recently used first. A listing is valid as
+    # long as the mtime of its directory is unchanged.
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes: int = max_bytes
+        self.size: int = 0
+        self._entries: Dict[Path, Tuple[int, DirectoryListing]] = {}
+        # Scans in progress, so concurrent requests for a large directory list it only once
+        self._pending: Dict[Tuple[Path, int], asyncio.Future] = {}
+
+    async def get(self, full_path: Path, mtime_ns: int) -> DirectoryListing:
+        entry = self._entries.pop(full_path, None)
+        if entry is not None:
+            if entry[0] == mtime_ns:
+                self._entries[full_path] = entry
+                return entry[1]
+            self.size -= entry[1].nbytes
+        pending_key = (full_path, mtime_ns)
+        pending = self._pending.get(pending_key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        pending = self._pending[pending_key] = asyncio.get_running_loop().run_in_executor(
+            None, scan_directory, full_path)
+        try:
+            listing: DirectoryListing = await asyncio.shield(pending)
+        finally:
+            del self._pending[pending_key]
+        if time.time_ns() - mtime_ns > LISTING_RACY_SECONDS * 10**9 and listing.nbytes <= self.max_bytes:
+            self._entries[full_path] = (mtime_ns, listing)
+            self.size += listing.nbytes
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.pop(next(iter(self._entries)))
+                self.size -= evicted.nbytes
+        return listing
+
+listing_cache_key = web.AppKey('listing_cache', ListingCache)
+
+async def stream_html_listing(request: web.Request, path: Path, listing: DirectoryListing, etag: str, mtime: float) -> web.StreamResponse:
+    # Writes the listing in batches with chunked encoding, so the whole page is never in memory
+    response = web.StreamResponse()
+    response.content_type = 'text/html'
+    response.etag = etag
+    response.last_modified = mtime
+    await response.prepare(request)
+    await response.write(f'<html><head><title>Index of: {path}</title></head><body><h1>Index of: {path}</h1><ul>'.encode('utf-8'))
+    items: List[str] = []
+    # Note: Since "path" is always relative and Path('.').parent == Path('.'), this will never escape the current directory
+    # Therefore we just remove the parent directory when we're at the root directory
+    if path != Path():
+        parent_dir: str = urllib.parse.quote(f'/{path.parent.as_posix()}') if path else ''
+        items += [f'<li><a href="{parent_dir}">&lt;Parent Directory&gt;</a></li>']
+    separator: str = ''
+    # Directories first, then files
+    for is_dir in (True, False):
+        for name, entry_is_dir in listing.entries:
+            if entry_is_dir != is_dir:
+                continue
+            entry_href: str = urllib.parse.quote(f'/{(path / name).as_posix()}')
+            if is_dir:
+                items.append(f'<li><a href="{entry_href}/">{name}/</a></li>')
+            else:
+                items.append(f'<li><a href="{entry_href}">{name}</a></li>')
+            if len(items) >= LISTING_BATCH:
+                await response.write((separator + ' '.join(items)).encode('utf-8'))
+                separator = ' '
+                items = []
+    if items:
+        await response.write((separator + ' '.join(items)).encode('utf-8'))
+    await response.write(b'</ul></body></html>')
+    await response.write_eof()
+    return response
+
+def encode_cursor(sort: str, entry: StatEntry) -> str:
+    field: int = JSON_SORT_FIELDS[sort]
+    return base64.urlsafe_b64encode(json.dumps([sort, entry[field], entry[0]]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str) -> Tuple[str, tuple]:
+    # Returns the sort order and the sort key of the last entry of the previous page
+    sort, value, name = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    if sort not in JSON_SORT_FIELDS or not isinstance(name, str):
+        raise ValueError('invalid cursor')
+    return sort, (value, name)
+
+async def stream_json_listing(request: web.Request, path: Path, full_path: Path, listing: DirectoryListing, etag: str, mtime: float) -> web.StreamResponse:
+    # Writes one page of the listing as JSON. Pages continue after the cursor of the previous
+    # page, which stays correct when entries are added or removed in between, or at an offset.
+    # Sizes and mtimes are read for each request, only for the entries of the page when sorting
+    # by name.
+    query = request.query
+    try:
+        limit: int = int(query.get('limit', JSON_PAGE_LIMIT))
+        offset: int = int(query.get('offset', 0))
+        sort: str = query.get('sort', 'name')
+        descending: bool = sort.startswith('-')
+        sort = sort.lstrip('-')
+        if sort not in JSON_SORT_FIELDS or not 0 < limit <= JSON_MAX_PAGE_LIMIT or offset < 0:
+            raise ValueError('invalid parameters')
+        cursor_key = None
+        if 'cursor' in query:
+            cursor_sort, cursor_key = decode_cursor(query['cursor'])
+            if cursor_sort != sort:
+                raise ValueError('cursor of another sort order')
+    except (ValueError, TypeError, json.JSONDecodeError, binascii.Error):
+        return web.Response(status=400, text='Invalid listing parameters')
+
+    loop = asyncio.get_running_loop()
+    field: int = JSON_SORT_FIELDS[sort]
+    if sort == 'name':
+        entries: list = listing.entries
+    else:
+        entries = await loop.run_in_executor(None, stat_entries, full_path, listing.entries)
+        entries.sort(key=lambda entry: (entry[field], entry[0]))
+    # Descending pages walk the ascending order backwards
+    sort_key = lambda entry: (entry[field], entry[0])
+    if not descending:
+        start: int = offset if cursor_key is None else bisect.bisect_right(entries, cursor_key, key=sort_key)
+        page = range(start, min(start + limit, len(entries)))
+        more: bool = page.stop < len(entries)
+    else:
+        stop: int = max(len(entries) - offset, 0) if cursor_key is None else bisect.bisect_left(entries, cursor_key, key=sort_key)
+        page = range(stop - 1, max(stop - limit, 0) - 1, -1)
+        more = max(stop - limit, 0) > 0
+    next_cursor = encode_cursor(sort, entries[page[-1]]) if more and page else None
+    page_entries: list = [entries[index] for index in page]
+    if sort == 'name':
+        page_entries = await loop.run_in_executor(None, stat_entries, full_path, page_entries)
+    etag = page_etag(etag, page_entries)
+    mtime = max([mtime] + [entry[3] / 1e9 for entry in page_entries])
+    if is_not_modified(request, etag, mtime):
+        return not_modified_response(etag, mtime)
+
+    response = web.StreamResponse()
+    response.content_type = 'application/json'
+    response.etag = etag
+    response.last_modified = mtime
+    await response.prepare(request)
+    await response.write(f'{{"path": {json.dumps(path.as_posix())}, "total": {len(entries)}, "next_cursor": {json.dumps(next_cursor)}, "entries": ['.encode('utf-8'))
+    for batch_start in range(0, len(page_entries), LISTING_BATCH):
+        batch: List[str] = []
+        for name, is_dir, size, mtime_ns in page_entries[batch_start:batch_start + LISTING_BATCH]:
+            batch.append(json.dumps({'name': name, 'type': 'dir' if is_dir else 'file', 'size': size, 'mtime': mtime_ns / 1e9}))
+        await response.write((', ' if batch_start else '').encode('utf-8') + ', '.join(batch).encode('utf-8'))
+    await response.write(b']}')
+    await response.write_eof()
+    return response
+
+class ThreadResponseStream:
+    # Write-only file object for a response produced in a worker thread, like a ZIP archive or a
+    # compressed file. Writes are buffered, then sent from the event loop, and the thread waits until
+    # the response accepted them, so a slow client throttles the thread instead of the data piling
+    # up in memory.
+    def __init__(self, response: web.StreamResponse, loop: asyncio.AbstractEventLoop) -> None:
+        self._response: web.StreamResponse = response
+        self._loop: asyncio.AbstractEventLoop = loop
+        self._buffer: bytearray = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        if len(self._buffer) >= ZIP_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self) -> None:
+        if self._buffer:
+            data: bytes = bytes(self._buffer)
+            self._buffer.clear()
+            asyncio.run_coroutine_threadsafe(self._response.write(data), self._loop).result()
+
+def write_zip(full_path: Path, root: Path, stream: ThreadResponseStream, compression: int) -> None:
+    # Archives the directory tree under its own name. The stream is not seekable, so sizes and
+    # checksums follow each file in a data descriptor, and ZIP64 records are used where needed.
+    # Like in the listings, symlinks are followed, but not outside of the served directory. The
+    # devices and inodes of the directories from the top to each one stop symlinks to a parent.
+    top_stat: os.stat_result = full_path.stat()
+    parents: Dict[str, FrozenSet[Tuple[int, int]]] = {os.fspath(full_path): frozenset({(top_stat.st_dev, top_stat.st_ino)})}
+    with zipfile.ZipFile(stream, 'w', compression=compression, allowZip64=True, strict_timestamps=False) as archive:
+        for dir_path, dir_names, file_names in os.walk(full_path, followlinks=True):
+            dir_parents: FrozenSet[Tuple[int, int]] = parents.pop(dir_path)
+            followed: List[str] = []
+            for name in sorted(dir_names):
+                sub_path: Path = Path(dir_path) / name
+                try:
+                    sub_stat: os.stat_result = sub_path.stat()
+                    if not sub_path.resolve().is_relative_to(root) or (sub_stat.st_dev, sub_stat.st_ino) in dir_parents:
+                        continue
+                except OSError:
+                    continue
+                parents[os.path.join(dir_path, name)] = dir_parents | {(sub_stat.st_dev, sub_stat.st_ino)}
+                followed.append(name)
+            dir_names[:] = followed
+            arc_dir: Path = Path(full_path.name) / Path(dir_path).relative_to(full_path)
+            if not dir_names and not file_names:
+                archive.mkdir(arc_dir.as_posix())
+            for name in sorted(file_names):
+                file_path: Path = Path(dir_path) / name
+                try:
+                    if not file_path.resolve().is_relative_to(root) or not file_path.is_file():
+                        continue
+                    info: zipfile.ZipInfo = zipfile.ZipInfo.from_file(file_path, (arc_dir / name).as_posix(), strict_timestamps=False)
+                    source = open(file_path, 'rb')
+                except OSError:
+                    continue
+                info.compress_type = compression
+                with source, archive.open(info, 'w') as destination:
+                    shutil.copyfileobj(source, destination, ZIP_CHUNK_SIZE)
+    stream.flush()
+
+async def stream_zip(request: web.Request, full_path: Path) -> web.StreamResponse:
+    compression = ZIP_COMPRESSION.get(request.query.get('compress', 'store'))
+    if compression is None:
+        return web.Response(status=400, text='Invalid compression')
+    response = web.StreamResponse()
+    response.content_type = 'application/zip'
+    response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{urllib.parse.quote(full_path.name or 'root')}.zip"
+    await response.prepare(request)
+    loop = asyncio.get_running_loop()
+    stream = ThreadResponseStream(response, loop)
+    await loop.run_in_executor(None, write_zip, full_path, Path.cwd().resolve(), stream, compression)
+    await response.write_eof()
+    return response
+
+def compressible_type(full_path: Path) -> Optional[str]:
+    # Returns the type of the file if it is worth compressing, and not compressed already
+    content_type, encoding = mimetypes.guess_type(full_path)
+    if content_type is None or encoding is not None:
+        return None
+    if content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES or content_type.endswith(('+json', '+xml')):
+        return content_type
+    return None
+
+def negotiate_encoding(request: web.Request) -> Optional[str]:
+    # Picks the preferred encoding accepted by the client, if any
+    accepted: Dict[str, float] = {}
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = item.partition(';')
+        quality: float = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in COMPRESSION_SUFFIXES:
+        if encoding == 'zstd' and zstandard is None:
+            continue
+        if accepted.get(encoding, 0) > 0:
+            return encoding
+    return None
+
+def new_compressor(encoding: str):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+class CompressionCache:
+    # Compressed files on disk by path, mtime, size and encoding. The directory itself is the cache,
+    # so that it is shared by all the server processes: hits refresh the mtime of their file, and
+    # eviction sizes the directory under a lock and removes the least recently used files. Files of
+    # changed files are never used again, and leave through eviction.
+    def __init__(self, cache_dir: Path, max_bytes: int) -> None:
+        self.cache_dir: Path = cache_dir
+        self.max_bytes: int = max_bytes
+
+    def load(self) -> None:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.evict()
+
+    def path(self, full_path: Path, full_stat: os.stat_result, encoding: str) -> Path:
+        key: str = hashlib.sha256(f'{full_path}\0{full_stat.st_mtime_ns}\0{full_stat.st_size}\0{encoding}'.encode('utf-8', 'surrogateescape')).hexdigest()
+        return self.cache_dir / f'{key}.{COMPRESSION_SUFFIXES[encoding]}'
+
+    def open(self, cache_path: Path) -> Optional[BinaryIO]:
+        # Opens the file if it is cached, and marks it as recently used
+        try:
+            cached: BinaryIO = open(cache_path, 'rb')
+        except FileNotFoundError:
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(cached.fileno())
+        return cached
+
+    def evict(self) -> None:
+        with open(self.cache_dir / COMPRESS_CACHE_LOCK_NAME, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries: List[Tuple[int, str, int]] = []
+            with os.scandir(self.cache_dir) as dir_entries:
+                for dir_entry in dir_entries:
+                    if dir_entry.name == COMPRESS_CACHE_LOCK_NAME or dir_entry.name.endswith('.tmp'):
+                        continue
+                    with contextlib.suppress(FileNotFoundError):
+                        entry_stat: os.stat_result = dir_entry.stat()
+                        entries.append((entry_stat.st_mtime_ns, dir_entry.name, entry_stat.st_size))
+            size: int = sum(entry_size for _, _, entry_size in entries)
+            for _, name, entry_size in sorted(entries):
+                if size <= self.max_bytes:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    (self.cache_dir / name).unlink()
+                size -= entry_size
+
+compression_cache_key = web.AppKey('compression_cache', CompressionCache)
+
+def compress_file(full_path: Path, encoding: str, stream: ThreadResponseStream, cache_path: Optional[Path]) -> None:
+    # Sends the compressed file, and also writes it to the compression cache if a path is given.
+    # The cached file is written under a temporary name, and only appears once complete.
+    compressor = new_compressor(encoding)
+    temp_path: Optional[Path] = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.{threading.get_ident()}.tmp') if cache_path else None
+    cache_file = open(temp_path, 'wb') if temp_path else None
+    try:
+        with open(full_path, 'rb') as source:
+            while True:
+                chunk: bytes = source.read(ZIP_CHUNK_SIZE)
+                compressed: bytes = compressor.compress(chunk) if chunk else compressor.flush()
+                stream.write(compressed)
+                if cache_file:
+                    cache_file.write(compressed)
+                if not chunk:
+                    break
+        stream.flush()
+        if cache_file:
+            cache_file.close()
+            os.replace(temp_path, cache_path)
+    except BaseException:
+        if cache_file:
+            cache_file.close()
+            temp_path.unlink()
+        raise
+
+async def send_compressed(request: web.Request, full_path: Path, full_stat: os.stat_result, content_type: str, encoding: str) -> web.StreamResponse:
+    # The ETag of each encoding extends the one FileResponse gives the file itself
+    etag: str = f'{full_stat.st_mtime_ns:x}-{full_stat.st_size:x}-{encoding}'
+    if is_not_modified(request, etag, full_stat.st_mtime):
+        response = web.Response(status=304)
+    else:
+        response = web.StreamResponse()
+        response.content_type = content_type
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.etag = etag
+    response.last_modified = full_stat.st_mtime
+    if response.status == 304:
+        return response
+
+    loop = asyncio.get_running_loop()
+    cache: CompressionCache = request.app[compression_cache_key]
+    cache_path: Path = cache.path(full_path, full_stat, encoding)
+    stream = ThreadResponseStream(response, loop)
+    # Small files are compressed again each time, rather than churning the cache
+    cacheable: bool = full_stat.st_size >= COMPRESS_CACHE_MIN_BYTES and cache.max_bytes > 0
+    cached: Optional[BinaryIO] = await loop.run_in_executor(None, cache.open, cache_path) if cacheable else None
+    if cached is not None:
+        with cached:
+            response.content_length = os.fstat(cached.fileno()).st_size
+            await response.prepare(request)
+            await loop.run_in_executor(None, shutil.copyfileobj, cached, stream, ZIP_CHUNK_SIZE)
+            await loop.run_in_executor(None, stream.flush)
+        await response.write_eof()
+        return response
+
+    await response.prepare(request)
+    await loop.run_in_executor(None, compress_file, full_path, encoding, stream, cache_path if cacheable else None)
+    await response.write_eof()
+    if cacheable:
+        await loop.run_in_executor(None, cache.evict)
+    return response
+
+def listing_etag(full_stat: os.stat_result, query: str) -> str:
+    # Names and types change the mtime of their directory, so with the inode it identifies an HTML
+    # listing, and the query its format and page. JSON listings extend it with page_etag().
+    query_hash: str = hashlib.blake2b(query.encode('utf-8'), digest_size=4).hexdigest()
+    return f'{full_stat.st_ino:x}-{full_stat.st_mtime_ns:x}-{query_hash}'
+
+def page_etag(etag: str, page_entries: List[StatEntry]) -> str:
+    digest = hashlib.blake2b(digest_size=8)
+    for name, _, size, mtime_ns in page_entries:
+        digest.update(f'{name}\0{size}\0{mtime_ns}\0'.encode('utf-8', 'surrogateescape'))
+    return f'{etag}-{digest.hexdigest()}'
+
+def not_modified_response(etag: str, mtime: float) -> web.Response:
+    response = web.Response(status=304)
+    response.etag = etag
+    response.last_modified = mtime
+    return response
+
+def is_not_modified(request: web.Request, etag: str, mtime: float) -> bool:
+    # If-None-Match takes precedence over If-Modified-Since, which only has a resolution of seconds
+    if request.if_none_match is not None:
+        return any(tag.value in (etag, '*') for tag in request.if_none_match)
+    if request.if_modified_since is not None:
+        return int(mtime) <= request.if_modified_since.timestamp()
+    return False
+
 class TreeHTTPRequestHandler(web.View):
-    async def get(self) -> web.Response:
+    async def get(self) -> web.StreamResponse:
         path: Path = Path(self.request.match_info.get('path', ''))
         if path.is_absolute():
             return web.Response(status=400, text='Absolute paths not allowed')
@@ -38,30 +570,320 @@ class TreeHTTPRequestHandler(web.View):
         if not full_path.is_relative_to(Path.cwd().resolve()):
             return web.Response(status=403, text='Access denied')
 
-        if not full_path.exists():
+        # full_path is already resolved, so one stat tells whether it exists and what it is
+        try:
+            full_stat: os.stat_result = await asyncio.get_running_loop().run_in_executor(
+                None, os.stat, full_path)
+        except OSError:
             return web.Response(status=404, text='File not found')
 
-        if full_path.resolve().is_dir():
-            dirs: List[str] = []
-            files: List[str] = []
-            # Note: Since "path" is always relative and Path('.').parent == Path('.'), this will never escape the current directory
-            # Therefore we just remove the parent directory when we're at the root directory
-            if path != Path():
-                parent_dir: str = urllib.parse.quote(f'/{path.parent.as_posix()}') if path else ''
-                dirs += [f'<li><a href="{parent_dir}">&lt;Parent Directory&gt;</a></li>']
-            for entry in sorted(full_path.iterdir()):
-                entry_href: str = urllib.parse.quote(f'/{(path / entry.name).as_posix()}')
-                if entry.resolve().is_dir():
-                    dirs += [f'<li><a href="{entry_href}/">{entry.name}/</a></li>']
-                elif entry.resolve().is_file():
-                    files += [f'<li><a href="{entry_href}">{entry.name}</a></li>']
-            body: bytes = f'<html><head><title>Index of: {path}</title></head><body><h1>Index of: {path}</h1><ul>{" ".join(dirs + files)}</ul></body></html>'.encode('utf-8')
-            return web.Response(body=body, content_type='text/html')
-        elif full_path.resolve().is_file():
-            return web.FileResponse(full_path)
+        if stat.S_ISDIR(full_stat.st_mode):
+            if self.request.query.get('download') == 'zip':
+                return await stream_zip(self.request, full_path)
+            etag: str = listing_etag(full_stat, self.request.query_string)
+            json_format: bool = self.request.query.get('format') == 'json'
+            # The validators of JSON listings also depend on the entries of the page
+            if not json_format and is_not_modified(self.request, etag, full_stat.st_mtime):
+                return not_modified_response(etag, full_stat.st_mtime)
+            try:
+                listing: DirectoryListing = await self.request.app[listing_cache_key].get(
+                    full_path, full_stat.st_mtime_ns)
+            except OSError:
+                return web.Response(status=403, text='Access denied')
+            if json_format:
+                return await stream_json_listing(self.request, path, full_path, listing, etag, full_stat.st_mtime)
+            return await stream_html_listing(self.request, path, listing, etag, full_stat.st_mtime)
+        elif stat.S_ISREG(full_stat.st_mode):
+            content_type: Optional[str] = compressible_type(full_path) if compression_cache_key in self.request.app else None
+            if content_type is None:
+                # FileResponse sets its own ETag and Last-Modified, and answers conditional and Range requests
+                return web.FileResponse(full_path)
+            # Ranges are only served from the file itself
+            encoding: Optional[str] = negotiate_encoding(self.request)
+            if encoding is None or 'Range' in self.request.headers or full_stat.st_size < COMPRESS_MIN_BYTES:
+                return web.FileResponse(full_path, headers={'Content-Type': content_type, 'Vary': 'Accept-Encoding'})
+            return await send_compressed(self.request, full_path, full_stat, content_type, encoding)
         else:
             return web.Response(status=404, text='File not found')
 
+class UploadWriter:
+    # Writes an uploaded file from a dedicated thread, so slow storage never stalls the event loop.
+    # Writes are queued in order, and once UPLOAD_QUEUE_DEPTH chunks are waiting the request is not
+    # read any further, so backpressure reaches the client through TCP flow control.
+    def __init__(self, file_path: Path, fsync: str) -> None:
+        self.file_path: Path = file_path
+        self.fsync: str = fsync
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload-writer')
+        self._pending: Deque[asyncio.Future] = deque()
+        self._file = None
+        # Offset of the first write into an existing file, or None when the file is created
+        self._offset: Optional[int] = None
+
+    async def _submit(self, func, *args) -> None:
+        if len(self._pending) >= UPLOAD_QUEUE_DEPTH:
+            await self._pending.popleft()
+        self._pending.append(asyncio.get_running_loop().run_in_executor(self._executor, func, *args))
+
+    async def open(self, offset: Optional[int] = None) -> None:
+        self._offset = offset
+        self._file = await asyncio.get_running_loop().run_in_executor(self._executor, self._open)
+
+    async def preallocate(self, size: int) -> None:
+        await self._submit(self._preallocate, size)
+
+    async def write(self, chunk: bytes) -> None:
+        await self._submit(self._write, chunk)
+
+    async def close(self) -> None:
+        # Waits for the queued writes, raising the first error
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending:
+                await self._pending.popleft()
+            await loop.run_in_executor(self._executor, self._finish)
+        finally:
+            for pending in self._pending:
+                pending.cancel()
+            self._executor.submit(self._file.close)
+            self._executor.shutdown(wait=False)
+
+    def _open(self):
+        if self._offset is None:
+            return open(self.file_path, 'wb')
+        file = open(self.file_path, 'r+b')
+        file.seek(self._offset)
+        return file
+
+    def _preallocate(self, size: int) -> None:
+        # The size is only an upper bound, and the file is truncated to its actual size when done
+        try:
+            os.posix_fallocate(self._file.fileno(), 0, size)
+        except OSError:
+            pass
+
+    def _write(self, chunk: bytes) -> None:
+        self._file.write(chunk)
+        if self.fsync == 'chunk':
+            self._file.flush()
+            os.fdatasync(self._file.fileno())
+
+    def _finish(self) -> None:
+        if self._offset is None:
+            self._file.truncate()
+        if self.fsync != 'none':
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._file.close()
+
+upload_dir_key = web.AppKey('upload_dir', Path)
+fsync_key = web.AppKey('fsync', str)
+
+# A resumable upload is a session directory with the file being uploaded, written at the offsets
+# given by the client, and a state file with the byte ranges received so far. Sessions are kept on
+# disk, so uploads also resume after a restart of the server.
+
+def merge_range(ranges: List[List[int]], start: int, end: int) -> List[List[int]]:
+    merged: List[List[int]] = []
+    for range_start, range_end in sorted(ranges + [[start, end]]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+def session_status(upload_id: str, state: dict) -> dict:
+    # The committed offset is where the data received from the start of the file ends
+    ranges: List[List[int]] = state['ranges']
+    committed: int = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+    return {'id': upload_id, 'name': state['name'], 'size': state['size'], 'directory': state['directory'],
+            'committed': committed, 'received': sum(end - start for start, end in ranges), 'ranges': ranges}
+
+def read_session_state(session_dir: Path) -> dict:
+    # The state file is only ever replaced as a whole, so it can be read without the lock
+    return json.loads((session_dir / 'state.json').read_text())
+
+def write_session_state(session_dir: Path, state: dict) -> None:
+    temp_path: Path = session_dir / 'state.json.tmp'
+    temp_path.write_text(json.dumps(state))
+    os.replace(temp_path, session_dir / 'state.json')
+
+@contextlib.contextmanager
+def locked_session(session_dir: Path):
+    # Chunks of a session may be written in parallel, possibly by different server processes, so
+    # the state is read, changed and written back under an exclusive lock
+    with open(session_dir / 'lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state: dict = read_session_state(session_dir)
+        yield state
+        write_session_state(session_dir, state)
+
+def expire_sessions(sessions_dir: Path) -> None:
+    # Deletes the sessions whose file and state were last written before UPLOAD_SESSION_EXPIRY, and
+    # the directories left without a state file by a failed creation
+    deadline: float = time.time() - UPLOAD_SESSION_EXPIRY
+    try:
+        session_dirs: List[Path] = list(sessions_dir.iterdir())
+    except FileNotFoundError:
+        return
+    for session_dir in session_dirs:
+        try:
+            mtime: float = max(path.stat().st_mtime for path in (session_dir, *session_dir.iterdir()))
+        except OSError:
+            continue
+        if mtime < deadline:
+            print(f'Upload {session_dir.name} has expired')
+            shutil.rmtree(session_dir, ignore_errors=True)
+
+def create_session(sessions_dir: Path, name: str, size: int, directory: str) -> Tuple[str, dict]:
+    # The size is checked against the free space, and a session that could not be created whole is
+    # deleted, so a request can neither fill the disk nor leave a session without a state
+    expire_sessions(sessions_dir)
+    sessions_dir.mkdir(parents=True, exist_ok=True)
+    usage = os.statvfs(sessions_dir)
+    if size > usage.f_bavail * usage.f_frsize:
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+    upload_id: str = secrets.token_urlsafe(16)
+    session_dir: Path = sessions_dir / upload_id
+    session_dir.mkdir()
+    try:
+        with open(session_dir / 'data', 'wb') as data:
+            data.truncate(size)
+            if size >= UPLOAD_PREALLOCATE_BYTES:
+                try:
+                    os.posix_fallocate(data.fileno(), 0, size)
+                except OSError as e:
+                    # Preallocation is only an optimization, unless the space is missing
+                    if e.errno in (errno.ENOSPC, errno.EDQUOT, errno.EFBIG):
+                        raise
+        state: dict = {'name': name, 'size': size, 'directory': directory, 'ranges': []}
+        write_session_state(session_dir, state)
+    except BaseException:
+        shutil.rmtree(session_dir, ignore_errors=True)
+        raise
+    return upload_id, state
+
+def commit_session_range(session_dir: Path, start: int, end: int) -> dict:
+    with locked_session(session_dir) as state:
+        state['ranges'] = merge_range(state['ranges'], start, end)
+    return state
+
+def finalize_session(session_dir: Path, upload_dir: Path) -> Tuple[Optional[Path], dict]:
+    # Moves the complete file into its upload directory, and returns None as its path when data is
+    # still missing. The directory is chosen by the client, so the file is linked rather than
+    # renamed, which never replaces an existing file, and gets a numbered name if needed.
+    with locked_session(session_dir) as state:
+        if state['ranges'] != [[0, state['size']]] and state['size'] > 0:
+            return None, state
+        name: Path = Path(state['name'])
+        file_path: Path = upload_dir / state['directory'] / name
+        file_path.parent.mkdir(exist_ok=True)
+        number: int = 1
+        while True:
+            try:
+                os.link(session_dir / 'data', file_path)
+                break
+            except FileExistsError:
+                file_path = file_path.with_name(f'{name.stem} ({number}){name.suffix}')
+                number += 1
+        state['name'] = file_path.name
+    shutil.rmtree(session_dir)
+    return file_path, state
+
+def get_session_dir(request: web.Request) -> Optional[Path]:
+    session_dir: Path = request.app[upload_dir_key] / UPLOAD_SESSIONS_DIR / request.match_info['upload_id']
+    return session_dir if (session_dir / 'state.json').is_file() else None
+
+async def handle_create_upload(request: web.Request) -> web.Response:
+    # Starts a resumable upload of the file "name" of "size" bytes. Files of the same batch are
+    # stored together by passing the directory returned for the first one.
+    name: str = Path(request.query.get('name', '')).name
+    try:
+        size: int = int(request.query.get('size', ''))
+    except ValueError:
+        return web.Response(status=400, text='Invalid size')
+    if name in ('', '.', '..') or size < 0:
+        return web.Response(status=400, text='Invalid name or size')
+    client_ip, client_port = get_ip_port(request)
+    directory: str = request.query.get('directory') or f'upload_{datetime.now().isoformat()}_{client_ip}:{client_port}'
+    if not re.fullmatch(r'upload_[^/\\]+', directory):
+        return web.Response(status=400, text='Invalid directory')
+    loop = asyncio.get_running_loop()
+    try:
+        upload_id, state = await loop.run_in_executor(
+            None, create_session, request.app[upload_dir_key] / UPLOAD_SESSIONS_DIR, name, size, directory)
+    except OSError as e:
+        if e.errno == errno.EFBIG:
+            return web.Response(status=413, text='File too large')
+        if e.errno in (errno.ENOSPC, errno.EDQUOT):
+            return web.Response(status=507, text='Not enough free space')
+        raise
+    print(f'Client {client_ip}:{client_port} started uploading {name} ({size} bytes) as {upload_id}')
+    return web.json_response(session_status(upload_id, state))
+
+async def handle_upload_status(request: web.Request) -> web.Response:
+    session_dir: Optional[Path] = get_session_dir(request)
+    if session_dir is None:
+        return web.Response(status=404, text='Upload not found')
+    state: dict = await asyncio.get_running_loop().run_in_executor(None, read_session_state, session_dir)
+    return web.json_response(session_status(request.match_info['upload_id'], state))
+
+async def handle_upload_chunk(request: web.Request) -> web.Response:
+    # Writes the request body at "offset". The range only counts as received once all of it is
+    # written, so a chunk cut off by a dropped connection is simply sent again.
+    session_dir: Optional[Path] = get_session_dir(request)
+    if session_dir is None:
+        return web.Response(status=404, text='Upload not found')
+    loop = asyncio.get_running_loop()
+    state: dict = await loop.run_in_executor(None, read_session_state, session_dir)
+    try:
+        offset: int = int(request.query.get('offset', ''))
+    except ValueError:
+        return web.Response(status=400, text='Invalid offset')
+    length: Optional[int] = request.content_length
+    if length is None:
+        return web.Response(status=411, text='Content-Length required')
+    if offset < 0 or offset + length > state['size'] or length > UPLOAD_MAX_CHUNK:
+        return web.Response(status=416, text='Chunk outside of the file')
+    writer = UploadWriter(session_dir / 'data', request.app[fsync_key])
+    try:
+        await writer.open(offset)
+    except FileNotFoundError:
+        # Finalized meanwhile
+        return web.Response(status=404, text='Upload not found')
+    written: int = 0
+    try:
+        while True:
+            chunk = await request.content.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            await writer.write(chunk)
+    finally:
+        await writer.close()
+    if written != length:
+        return web.Response(status=400, text='Incomplete chunk')
+    try:
+        state = await loop.run_in_executor(None, commit_session_range, session_dir, offset, offset + length)
+    except FileNotFoundError:
+        return web.Response(status=404, text='Upload not found')
+    return web.json_response(session_status(request.match_info['upload_id'], state))
+
+async def handle_finalize_upload(request: web.Request) -> web.Response:
+    session_dir: Optional[Path] = get_session_dir(request)
+    if session_dir is None:
+        return web.Response(status=404, text='Upload not found')
+    try:
+        file_path, state = await asyncio.get_running_loop().run_in_executor(
+            None, finalize_session, session_dir, request.app[upload_dir_key])
+    except FileNotFoundError:
+        # Finalized by a concurrent request
+        return web.Response(status=404, text='Upload not found')
+    if file_path is None:
+        return web.json_response(session_status(request.match_info['upload_id'], state), status=409)
+    client_ip, client_port = get_ip_port(request)
+    print(f'Client {client_ip}:{client_port} has finished uploading {file_path}')
+    return web.json_response({'name': state['name'], 'size': state['size'], 'directory': state['directory']})
+
 async def handle_upload_page(request: web.Request) -> web.Response:
     client_ip, client_port = get_ip_port(request)
     print(f'Client {client_ip}:{client_port} opened upload page')
@@ -70,6 +892,90 @@ async def handle_upload_page(request: web.Request) -> web.Response:
         <head>
             <title>Upload File</title>
             <script>
+                // Files are sent in chunks of resumable uploads, a few chunks at a time. Failed
+                // requests are retried, and an interrupted upload resumes when the same file is
+                // uploaded again, even after reloading the page.
+                var CHUNK_SIZE = 8 * 1024 * 1024;
+                var PARALLEL_CHUNKS = 3;
+
+                function sleep(ms) {
+                    return new Promise(function (resolve) { setTimeout(resolve, ms); });
+                }
+
+                async function request(method, url, body) {
+                    // Retries network and server errors, backing off up to 30 seconds
+                    for (var delay = 500; ; delay = Math.min(2 * delay, 30000)) {
+                        var response = null;
+                        try {
+                            response = await fetch(url, {method: method, body: body});
+                        } catch (error) {
+                        }
+                        if (response && response.ok) {
+                            return await response.json();
+                        }
+                        if (response && response.status < 500) {
+                            throw new Error(await response.text());
+                        }
+                        await sleep(delay);
+                    }
+                }
+
+                async function uploadFile(file, directory, item) {
+                    var key = 'aioftws:' + file.name + ':' + file.size + ':' + file.lastModified;
+                    var status = null;
+                    if (localStorage.getItem(key)) {
+                        try {
+                            status = await request('GET', '/uploads/' + localStorage.getItem(key));
+                        } catch (error) {
+                        }
+                    }
+                    if (!status) {
+                        status = await request('POST', '/uploads?name=' + encodeURIComponent(file.name) + '&size=' + file.size +
+                                               (directory ? '&directory=' + encodeURIComponent(directory) : ''));
+                        localStorage.setItem(key, status.id);
+                    }
+                    var chunks = [];
+                    for (var start = 0; start < file.size; start += CHUNK_SIZE) {
+                        var end = Math.min(start + CHUNK_SIZE, file.size);
+                        if (!status.ranges.some(function (range) { return range[0] <= start && end <= range[1]; })) {
+                            chunks.push(start);
+                        }
+                    }
+                    async function sendChunks() {
+                        while (chunks.length) {
+                            var start = chunks.shift();
+                            var chunkStatus = await request('PUT', '/uploads/' + status.id + '?offset=' + start,
+                                                            file.slice(start, Math.min(start + CHUNK_SIZE, file.size)));
+                            item.textContent = file.name + ': ' + Math.floor(100 * chunkStatus.received / file.size) + '%';
+                        }
+                    }
+                    var senders = [];
+                    for (var i = 0; i < PARALLEL_CHUNKS; i++) {
+                        senders.push(sendChunks());
+                    }
+                    await Promise.all(senders);
+                    var result = await request('POST', '/uploads/' + status.id + '/finalize');
+                    localStorage.removeItem(key);
+                    item.textContent = result.name + ', size: ' + result.size + ' bytes';
+                    return result.directory;
+                }
+
+                async function uploadFiles(event) {
+                    event.preventDefault();
+                    var input = document.getElementById('fileInput');
+                    var list = document.getElementById('fileList');
+                    updateFileList();
+                    var directory = null;
+                    for (var i = 0; i < input.files.length; i++) {
+                        try {
+                            var fileDirectory = await uploadFile(input.files[i], directory, list.children[i]);
+                            directory = directory || fileDirectory;
+                        } catch (error) {
+                            list.children[i].textContent = input.files[i].name + ': ' + error.message;
+                        }
+                    }
+                }
+
                 function updateFileList() {
                     var input = document.getElementById('fileInput');
                     var list = document.getElementById('fileList');
@@ -84,7 +990,7 @@ async def handle_upload_page(request: web.Request) -> web.Response:
         </head>
         <body>
             <h1>Upload File</h1>
-            <form action="/upload" method="post" enctype="multipart/form-data">
+            <form action="/upload" method="post" enctype="multipart/form-data" onsubmit="uploadFiles(event)">
                 <input type="file" name="file[]" id="fileInput" multiple onchange="updateFileList()">
                 <ul id="fileList"></ul>
                 <input type="submit" value="Upload">
@@ -102,9 +1008,12 @@ async def handle_upload(request: web.Request) -> web.Response:
     client_ip, client_port = get_ip_port(request)
     print(f'Client {client_ip}:{client_port} is uploading files...')
     upload_time: str = datetime.now().isoformat()
-    upload_dir: Path = Path(f"/tmp/upload_{upload_time}_{client_ip}:{client_port}")
+    upload_dir: Path = request.app[upload_dir_key] / f'upload_{upload_time}_{client_ip}:{client_port}'
     upload_dir.mkdir(parents=True, exist_ok=True)
     uploaded_files: List[str] = []
+    # Bytes of the request taken by the previous files, so the rest of the request bounds the size
+    # of the current file
+    uploaded_bytes: int = 0
     while True:
         field = await reader.next()
         if field is None:
@@ -113,13 +1022,20 @@ async def handle_upload(request: web.Request) -> web.Response:
             filename: str = field.filename
             size: int = 0
             file_path: Path = upload_dir / filename
-            with open(file_path, 'wb') as f:
+            writer = UploadWriter(file_path, request.app[fsync_key])
+            await writer.open()
+            try:
                 while True:
-                    chunk = await field.read_chunk()  # 8192 bytes by default.
+                    chunk = await field.read_chunk(UPLOAD_CHUNK_SIZE)
                     if not chunk:
                         break
+                    if size < UPLOAD_PREALLOCATE_BYTES <= size + len(chunk) and request.content_length:
+                        await writer.preallocate(request.content_length - uploaded_bytes)
                     size += len(chunk)
-                    f.write(chunk)
+                    await writer.write(chunk)
+            finally:
+                await writer.close()
+            uploaded_bytes += size
             uploaded_files.append(f'<li>{filename}, size: {size} bytes</li>')
     body = f'''
     <html>
@@ -134,25 +1050,248 @@ async def handle_upload(request: web.Request) -> web.Response:
     print(f'Client {client_ip}:{client_port} has finished uploading {len(uploaded_files)} {"file" if len(uploaded_files) == 1 else "files"}')
     return web.Response(body=body.encode('utf-8'), content_type='text/html')
 
-async def init_app(mode: str) -> web.Application:
+async def init_app(args: argparse.Namespace) -> web.Application:
     app = web.Application()
+    app[cache_control_key] = args.cache_control
     app.on_response_prepare.append(on_prepare)
 
-    if mode == 'tree':
+    if args.mode == 'tree':
+        app[listing_cache_key] = ListingCache(args.listing_cache * 2**20)
+        if args.compress:
+            app[compression_cache_key] = CompressionCache(Path(args.compress_cache), args.compress_cache_size * 2**20)
+            await asyncio.get_running_loop().run_in_executor(None, app[compression_cache_key].load)
         app.router.add_get('/{path:.*}', TreeHTTPRequestHandler)
-    elif mode == 'upload':
+    elif args.mode in ('upload', 'bench'):
+        app[upload_dir_key] = Path(args.upload_dir)
+        app[fsync_key] = args.fsync
+        await asyncio.get_running_loop().run_in_executor(None, expire_sessions, app[upload_dir_key] / UPLOAD_SESSIONS_DIR)
         app.router.add_get('/', handle_upload_page)
         app.router.add_post('/upload', handle_upload)
+        app.router.add_post('/uploads', handle_create_upload)
+        app.router.add_get('/uploads/{upload_id:[A-Za-z0-9_-]+}', handle_upload_status)
+        app.router.add_put('/uploads/{upload_id:[A-Za-z0-9_-]+}', handle_upload_chunk)
+        app.router.add_post('/uploads/{upload_id:[A-Za-z0-9_-]+}/finalize', handle_finalize_upload)
     
     return app
 
-async def run_server(app: web.Application, ip: str, port: int) -> None:
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, ip, port)
+async def run_server(runner: web.AppRunner, ip: str, port: int, reuse_port: bool) -> None:
+    site = web.TCPSite(runner, ip, port, reuse_port=reuse_port)
     await site.start()
     print(f'Serving on {ip}:{port}')
 
+async def serve(args: argparse.Namespace, ip_addresses: List[str], reuse_port: bool) -> None:
+    # Serves until SIGTERM or SIGINT, then stops accepting connections and lets the requests in
+    # progress finish. A second signal stops at once.
+    app: web.Application = await init_app(args)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    await asyncio.gather(*(run_server(runner, ip, args.port, reuse_port) for ip in ip_addresses))
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.remove_signal_handler(signum)
+    print(f'Process {os.getpid()} is shutting down')
+    await runner.cleanup()
+
+def supervise(args: argparse.Namespace, ip_addresses: List[str]) -> None:
+    # Forks the workers, which all listen on the same addresses with SO_REUSEPORT so the kernel
+    # spreads the connections over them, and restarts the workers that die. SIGTERM or SIGINT is
+    # passed on to the workers, and returns once they all finished.
+    workers: Dict[int, Tuple[int, float]] = {}
+    # Number of times in a row each worker died soon after starting
+    fast_failures: Dict[int, int] = {}
+    stopping: bool = False
+    failed: bool = False
+
+    def start_worker(index: int) -> None:
+        pid: int = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            exit_code: int = 0
+            try:
+                asyncio.run(serve(args, ip_addresses, reuse_port=True))
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        workers[pid] = (index, time.monotonic())
+
+    def stop(signum: int, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(args.workers):
+        start_worker(index)
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        if pid not in workers:
+            continue
+        index, started = workers.pop(pid)
+        if stopping:
+            continue
+        exit_code: int = os.waitstatus_to_exitcode(status)
+        fast: bool = time.monotonic() - started < WORKER_RESTART_DELAY
+        fast_failures[index] = fast_failures.get(index, 0) + 1 if fast else 0
+        if fast_failures[index] >= WORKER_MAX_FAST_FAILURES:
+            print(f'Worker {index} (process {pid}) exited with status {exit_code} {fast_failures[index]} times in a row on startup, stopping')
+            failed = True
+            stop(signal.SIGTERM, None)
+            continue
+        print(f'Worker {index} (process {pid}) exited with status {exit_code}, restarting it')
+        if fast:
+            time.sleep(WORKER_RESTART_DELAY)
+        # The signal may have come while sleeping
+        if not stopping:
+            start_worker(index)
+    if failed:
+        raise RuntimeError('Workers keep failing on startup')
+
+class RepeatedPayload(payload.Payload):
+    # Upload body for the benchmark that repeats a block, so the uploaded data is never in memory
+    def __init__(self, block: bytes, count: int, filename: str) -> None:
+        super().__init__(block, filename=filename)
+        self._size = len(block) * count
+        self._count: int = count
+
+    async def write(self, writer) -> None:
+        for _ in range(self._count):
+            await writer.write(self._value)
+
+    def decode(self, encoding: str = 'utf-8', errors: str = 'strict') -> str:
+        raise TypeError('Benchmark uploads cannot be decoded')
+
+async def measure_loop_stalls(stalls: List[float], interval: float = 0.01) -> None:
+    # Records by how much each wake up of the event loop was late
+    loop = asyncio.get_running_loop()
+    while True:
+        start: float = loop.time()
+        await asyncio.sleep(interval)
+        stalls.append(loop.time() - start - interval)
+
+async def bench_upload_client(url: str, index: int, block: bytes, count: int) -> float:
+    data = FormData()
+    data.add_field('file[]', RepeatedPayload(block, count, f'bench_{index}.bin'), filename=f'bench_{index}.bin')
+    start: float = time.perf_counter()
+    async with ClientSession() as session:
+        async with session.post(url, data=data) as response:
+            response.raise_for_status()
+            await response.read()
+    return time.perf_counter() - start
+
+async def bench_uploads(args: argparse.Namespace, ip: str) -> None:
+    # Uploads from several clients at once to a server in this process, and reports the sustained
+    # throughput and how long the event loop was blocked at most
+    bench_dir: str = tempfile.mkdtemp(prefix='aioftws_bench_', dir=args.upload_dir)
+    runner = web.AppRunner(await init_app(argparse.Namespace(**{**vars(args), 'upload_dir': bench_dir})))
+    await runner.setup()
+    await web.TCPSite(runner, ip, args.port).start()
+    host: str = f'[{ip}]' if ':' in ip else ip
+    url: str = f'http://{host}:{args.port}/upload'
+    block: bytes = os.urandom(UPLOAD_CHUNK_SIZE)
+    count: int = args.bench_size * 2**20 // len(block)
+    stalls: List[float] = []
+    stall_task = asyncio.create_task(measure_loop_stalls(stalls))
+    start: float = time.perf_counter()
+    durations: List[float] = await asyncio.gather(
+        *(bench_upload_client(url, index, block, count) for index in range(args.clients)))
+    elapsed: float = time.perf_counter() - start
+    stall_task.cancel()
+    await runner.cleanup()
+    shutil.rmtree(bench_dir)
+    mib: float = count * len(block) / 2**20
+    for index, duration in enumerate(durations):
+        print(f'Client {index}: {mib:.0f} MiB in {duration:.2f} s, {mib / duration:.1f} MiB/s')
+    print(f'Total: {mib * args.clients:.0f} MiB in {elapsed:.2f} s, {mib * args.clients / elapsed:.1f} MiB/s '
+          f'(fsync: {args.fsync}), longest event loop stall: {max(stalls, default=0) * 1000:.1f} ms')
+
+async def fetch_part(session: ClientSession, url: str, etag: Optional[str], fd: int, start: int, end: int) -> None:
+    # Downloads bytes start to end - 1 to the same offset of the output, resuming after errors.
+    # If-Match makes the server refuse the request if the file changed since the download started.
+    loop = asyncio.get_running_loop()
+    position: int = start
+    for attempt in range(FETCH_RETRIES + 1):
+        headers: Dict[str, str] = {'Range': f'bytes={position}-{end - 1}'}
+        if etag is not None:
+            headers['If-Match'] = etag
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 412:
+                    raise RuntimeError('The file changed on the server during the download')
+                if response.status != 206 or not response.headers.get('Content-Range', '').startswith(f'bytes {position}-{end - 1}/'):
+                    raise RuntimeError(f'Unexpected response to a Range request: {response.status}')
+                async for chunk in response.content.iter_chunked(FETCH_CHUNK_SIZE):
+                    await loop.run_in_executor(None, os.pwrite, fd, chunk, position)
+                    position += len(chunk)
+            if position == end:
+                return
+        except (ClientError, asyncio.TimeoutError) as error:
+            if attempt == FETCH_RETRIES:
+                raise RuntimeError(f'Downloading bytes {position}-{end - 1} failed: {error}')
+        await asyncio.sleep(2**attempt)
+    raise RuntimeError(f'Downloading bytes {position}-{end - 1} failed: the response ended early')
+
+async def fetch(url: str, output: Optional[str], connections: int, sha256: Optional[str]) -> None:
+    # Downloads a file with parallel Range requests into a temporary file, which is renamed once
+    # the download is complete and verified
+    output_path: Path = Path(output or urllib.parse.unquote(Path(urllib.parse.urlsplit(url).path).name) or 'index.html')
+    part_path: Path = output_path.with_name(output_path.name + '.part')
+    start: float = time.perf_counter()
+    # The validators and ranges are those of the file itself, so compression is never accepted
+    async with ClientSession(headers={'Accept-Encoding': 'identity'}) as session:
+        # The first byte tells the size of the file and its validators
+        async with session.get(url, headers={'Range': 'bytes=0-0'}) as response:
+            if response.status not in (200, 206, 416):
+                raise RuntimeError(f'Request failed: {response.status} {response.reason}')
+            etag: Optional[str] = response.headers.get('ETag')
+            content_range: str = response.headers.get('Content-Range', '')
+            if response.status == 200:
+                # No Range support, so the whole file is in this response
+                size: Optional[int] = None
+                with open(part_path, 'wb') as part:
+                    async for chunk in response.content.iter_chunked(FETCH_CHUNK_SIZE):
+                        part.write(chunk)
+            else:
+                size = int(content_range.rpartition('/')[2])
+        if size is not None:
+            fd: int = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.ftruncate(fd, size)
+                part_size: int = max(-(-size // connections), FETCH_MIN_PART)
+                await asyncio.gather(*(fetch_part(session, url, etag, fd, part_start, min(part_start + part_size, size))
+                                       for part_start in range(0, size, part_size)))
+            finally:
+                os.close(fd)
+            # Every part checked its Content-Range against If-Match; check once more that the file is
+            # still the one that was downloaded
+            if etag is not None:
+                async with session.get(url, headers={'If-None-Match': etag}) as response:
+                    if response.status != 304:
+                        raise RuntimeError('The file changed on the server during the download')
+    if sha256 is not None:
+        digest = hashlib.sha256()
+        with open(part_path, 'rb') as part:
+            while chunk := part.read(FETCH_CHUNK_SIZE):
+                digest.update(chunk)
+        if digest.hexdigest() != sha256.lower():
+            raise RuntimeError(f'SHA-256 mismatch: got {digest.hexdigest()}')
+    os.replace(part_path, output_path)
+    elapsed: float = time.perf_counter() - start
+    downloaded: int = output_path.stat().st_size
+    print(f'Downloaded {output_path}: {downloaded} bytes in {elapsed:.2f} s, {downloaded / 2**20 / elapsed:.1f} MiB/s')
+
 def get_private_and_link_local_ips() -> List[str]:
     ip_addresses: List[str] = []
     for iface in netifaces.interfaces():
@@ -166,13 +1305,48 @@ def get_private_and_link_local_ips() -> List[str]:
     return ip_addresses
 
 def main() -> None:
-    parser = argparse.ArgumentParser(description='Start an async web server in either tree or upload mode.')
-    parser.add_argument('mode', choices=['tree', 'upload'], help='Mode to run the server in')
-    parser.add_argument('-p', '--port', type=int, default=8080, help='Port to listen on')
-    parser.add_argument('-a', '--address', help='Specific IP address to listen to')
+    # The address and port are accepted both before and after the mode. The defaults are only set on
+    # the main parser, so they don't override values given before the mode.
+    server_options = argparse.ArgumentParser(add_help=False)
+    server_options.add_argument('-p', '--port', type=int, default=argparse.SUPPRESS, help='Port to listen on (default: 8080)')
+    server_options.add_argument('-a', '--address', default=argparse.SUPPRESS, help='Specific IP address to listen to')
+    parser = argparse.ArgumentParser(description='Start an async web server in either tree or upload mode, or download a file from one.')
+    parser.add_argument('-p', '--port', type=int, default=8080, help=argparse.SUPPRESS)
+    parser.add_argument('-a', '--address', help=argparse.SUPPRESS)
+    modes = parser.add_subparsers(dest='mode', required=True, help='Mode to run in')
+
+    tree_parser = modes.add_parser('tree', parents=[server_options], help='Serve the files of the current directory')
+    tree_parser.add_argument('--listing-cache', type=int, default=LISTING_CACHE_MIB, help=f'Maximum size of the directory listings cached in memory, in MiB (default: {LISTING_CACHE_MIB})')
+    tree_parser.add_argument('--cache-control', default=CACHE_CONTROL['tree'], help=f'Cache-Control of the responses (default: {CACHE_CONTROL["tree"]})')
+    tree_parser.add_argument('--no-compress', dest='compress', action='store_false', help='Never compress text files, even when the client accepts gzip or zstd')
+    tree_parser.add_argument('--compress-cache', default=Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'aioftws', help='Directory in which compressed files are kept (default: %(default)s)')
+    tree_parser.add_argument('--compress-cache-size', type=int, default=COMPRESS_CACHE_MIB, help=f'Maximum size of the compressed files kept, in MiB, or 0 to not keep any (default: {COMPRESS_CACHE_MIB})')
+
+    upload_parser = modes.add_parser('upload', parents=[server_options], help='Receive uploaded files')
+    bench_parser = modes.add_parser('bench', parents=[server_options], help='Benchmark concurrent uploads to a local server')
+    for server_mode_parser in (tree_parser, upload_parser):
+        server_mode_parser.add_argument('--workers', type=int, default=1, help='Number of server processes sharing the addresses with SO_REUSEPORT, restarted when they die (default: 1)')
+    for upload_mode_parser in (upload_parser, bench_parser):
+        upload_mode_parser.add_argument('--upload-dir', default='/tmp', help='Directory in which uploads are stored (default: /tmp)')
+        upload_mode_parser.add_argument('--fsync', choices=FSYNC_POLICIES, default='none', help='When uploaded files are flushed to storage: never, once complete, or after each chunk (default: none)')
+        upload_mode_parser.add_argument('--cache-control', default=CACHE_CONTROL['upload'], help=f'Cache-Control of the responses (default: {CACHE_CONTROL["upload"]})')
+    bench_parser.add_argument('--clients', type=int, default=4, help='Number of concurrent uploads (default: 4)')
+    bench_parser.add_argument('--bench-size', type=int, default=1024, help='Size of each upload, in MiB (default: 1024)')
+
+    fetch_parser = modes.add_parser('fetch', help='Download a file with parallel Range requests')
+    fetch_parser.add_argument('url', help='URL of the file')
+    fetch_parser.add_argument('-o', '--output', help='Path of the downloaded file (default: name of the file in the URL)')
+    fetch_parser.add_argument('-c', '--connections', type=int, default=FETCH_CONNECTIONS, help=f'Number of parallel requests (default: {FETCH_CONNECTIONS})')
+    fetch_parser.add_argument('--sha256', help='Expected SHA-256 of the file, verified before the download is kept')
     args = parser.parse_args()
 
-    port: int = args.port
+    if args.mode == 'fetch':
+        asyncio.run(fetch(args.url, args.output, args.connections, args.sha256))
+        return
+
+    if args.mode == 'bench':
+        asyncio.run(bench_uploads(args, args.address or '127.0.0.1'))
+        return
 
     if args.address:
         ip_addresses: List[str] = [args.address]
@@ -182,14 +1356,10 @@ def main() -> None:
         if not ip_addresses:
             raise RuntimeError("No private or link-local IP addresses found.")
 
-    loop = asyncio.get_event_loop()
-    app: web.Application = loop.run_until_complete(init_app(args.mode))
-
-    tasks = [run_server(app, ip, port) for ip in ip_addresses]
-    loop.run_until_complete(asyncio.gather(*tasks))
-
-    # Keep the loop running
-    loop.run_forever()
+    if args.workers > 1:
+        supervise(args, ip_addresses)
+    else:
+        asyncio.run(serve(args, ip_addresses, reuse_port=False))
 
 if __name__ == '__main__':
     main()
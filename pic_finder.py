@@ -2,17 +2,110 @@
 # -*- coding: utf-8 -*-
 
 from pathlib import Path
+from multiprocessing import shared_memory
 import argparse
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
+import hashlib
+import http.server
+import io
+import json
+import math
+import mmap
 import multiprocessing
 import numpy as np
 import os
+import random
+import socketserver
+import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import typing
+import urllib.parse
+import zipfile
 
 import cv2
 """
 Find similar image by comparing image keypoints
 
 The processing pipeline and choice of algorithms are not my own.
+
+Usage:
+    pic_finder.py search [--cache CACHE_DIR] [--match-mode MODE] query_img [query_img ...] img_root
+    pic_finder.py bench match-modes query_img [query_img ...] img_root
+    pic_finder.py bench decode img_root
+    pic_finder.py bench executor query_img [query_img ...] img_root
+    pic_finder.py index build [--cache CACHE_DIR] img_root index_dir
+    pic_finder.py search --index INDEX_DIR query_img [query_img ...] img_root
+    pic_finder.py search --cascade [--refine N] [--ransac] query_img [query_img ...] img_root
+    pic_finder.py pca train [--dims D] [--rootsift] img_root basis_file
+    pic_finder.py search [--rootsift] [--pca basis_file [--quantize]] query_img [query_img ...] img_root
+    pic_finder.py bench compact --pca basis_file query_img [query_img ...] img_root
+    pic_finder.py serve [--listen HOST:PORT | --unix PATH] [--cache CACHE_DIR] img_root
+    pic_finder.py search --mode phash [--max-distance D] query_img [query_img ...] img_root
+    pic_finder.py search --video [--frame-interval S | --scene-threshold T] query_img [...] img_root
+    pic_finder.py dupes [--mode phash] [--max-distance D] img_root
+    pic_finder.py dupes --mode sift --cache CACHE_DIR [--min-good N] img_root
+    pic_finder.py cache compact CACHE_DIR
+    pic_finder.py cache invalidate CACHE_DIR PATH [PATH ...]
+
+Zip, cbz and uncompressed tar archives are scanned like directories, without extracting them. Images
+inside an archive are reported as ARCHIVE!/MEMBER, e.g. comics/issue1.cbz!/page01.jpg, and are
+accepted wherever an image path is.
+
+With --executor thread, images are processed by threads of the main process instead of worker
+processes. OpenCV releases the GIL while decoding, detecting and matching, so threads scale
+similarly while sharing the query descriptors, cache and interpreter. Compare both executors with
+"bench executor".
+
+With --video, video files are scanned too. Frames are sampled every --frame-interval seconds, or
+with --scene-threshold, whenever the picture changes by more than the threshold. Skipped frames are
+only grabbed or seeked over, not converted. Videos are split into segments of --segment-seconds,
+which are scanned by different workers. A sampled frame is reported as VIDEO#t=SECONDS, and only
+the best frame of every video is printed. Such frame paths are also accepted as query images.
+
+While scanning, a progress line shows the number of images per second, the ETA once all images
+are listed, and the number of errors. Afterwards, the p50, p95 and maximum durations of the stat,
+decode, downscale, detect and match stages are printed to standard error, and with --stats-jsonl,
+appended to a JSON Lines file.
+
+If img_root is -, a NUL-separated list of image paths is read from standard input instead, e.g.
+from find -print0.
+
+Each query_img may be an image or a directory of images. The library is scanned once for all of
+them, and a separate list of top matches is printed per query image.
+
+With --cache, descriptors are stored persistently so a rescan only decodes new or changed images.
+
+With --cascade, every image is first scored at a small size with few keypoints, and only the
+top --refine images per query are scored again at the full --resize size. With --ransac, the final
+score is the number of matches consistent with a RANSAC homography.
+
+With --rootsift, SIFT descriptors are L1-normalized and square-rooted (RootSIFT). With --pca, they
+are projected onto a PCA basis trained by "pca train", and with --quantize, the projections are
+stored as uint8. Compact descriptors use less memory and cache space and are faster to match.
+
+The serve command keeps the descriptors of img_root in memory and answers queries over HTTP,
+rescanning img_root periodically for new, modified and deleted images:
+    GET /search?path=QUERY_PATH&top=K    Search with an image file on the server
+    POST /search?top=K                   Search with the image in the request body
+    GET /status                          Number of images in memory
+Results are returned as JSON.
+
+With --mode phash, near duplicates are found with a 64-bit perceptual hash per image instead of
+keypoint matching. All images within a Hamming distance of --max-distance are printed.
+
+The dupes command with --mode sift matches every image against every other image through a FLANN
+index over the descriptors of many images, built for one shard of the library at a time, and
+groups images with at least --min-good good matches.
+
+With --index, a global VLAD vector per image is used to select a few hundred candidates, and only
+those candidates are compared with the query images using keypoint matching.
 """
 
 # Globals for user interface
@@ -22,32 +115,219 @@ NTOP = 50
 # ANSI escape code to clear line
 ANSI_CL = '\033[K'
 
+# Globals for library scanning
+
+# File extensions of images that OpenCV can decode
+IMAGE_EXTENSIONS = frozenset((
+    '.bmp', '.dib', '.jpeg', '.jpg', '.jpe', '.jp2', '.png', '.webp', '.avif', '.pbm', '.pgm', '.ppm',
+    '.pxm', '.pnm', '.pfm', '.sr', '.ras', '.tiff', '.tif', '.exr', '.hdr', '.pic'
+))
+# Leading bytes of image formats that OpenCV can decode, for --sniff
+IMAGE_MAGIC_BYTES = (
+    b'\xff\xd8\xff', # JPEG
+    b'\x89PNG\r\n\x1a\n', # PNG
+    b'BM', # BMP
+    b'II*\x00', # TIFF, little endian
+    b'MM\x00*', # TIFF, big endian
+    b'\x00\x00\x00\x0cjP  \r\n', # JPEG 2000
+    b'\x59\xa6\x6a\x95', # Sun raster
+    b'\x76\x2f\x31\x01', # OpenEXR
+    b'#?RADIANCE', # Radiance HDR
+)
+# Number of bytes to read for --sniff
+IMAGE_MAGIC_LENGTH = max(map(len, IMAGE_MAGIC_BYTES))
+# Number of threads listing directories in parallel
+SCAN_THREADS = 8
+# Archives scanned like directories, by file extension. Compressed tar archives are not supported,
+# since their members cannot be read without decompressing everything before them.
+ARCHIVE_EXTENSIONS = {
+    '.zip': 'zip',
+    '.cbz': 'zip',
+    '.tar': 'tar',
+    '.cbt': 'tar',
+}
+# Separates the archive path from the member name in the path of an image inside an archive
+ARCHIVE_SEPARATOR = '!/'
+# Number of archives kept open per process
+ARCHIVE_CACHE_SIZE = 16
+# How images are processed: by a pool of worker processes or by threads of the main process
+EXECUTORS = ('process', 'thread')
+# Seconds between memory samples of "bench executor"
+BENCH_MEMORY_INTERVAL = 0.05
+
+# Globals for video scanning
+
+# File extensions of videos scanned with --video
+VIDEO_EXTENSIONS = frozenset((
+    '.mp4', '.m4v', '.mkv', '.webm', '.avi', '.mov', '.wmv', '.flv', '.mpg', '.mpeg', '.ts', '.3gp'
+))
+# Separates the video path from the time range of a segment or the timestamp of a frame, as in a
+# media fragment URI, e.g. clip.mp4#t=60,120 or clip.mp4#t=83.400
+VIDEO_FRAGMENT = '#t='
+# Default seconds between sampled frames
+VIDEO_FRAME_INTERVAL = 2.0
+# Seconds between frames compared for scene changes with --scene-threshold
+VIDEO_SCENE_INTERVAL = 0.25
+# Size of the grayscale thumbnails compared for scene changes
+VIDEO_SCENE_THUMBNAIL = (64, 36)
+# Default length of the video segments scanned by one worker
+VIDEO_SEGMENT_SECONDS = 60.0
+# Frames to skip at once above which seeking is faster than grabbing every frame, in seconds
+VIDEO_SEEK_SECONDS = 5.0
+
+# Globals for telemetry
+
+# Stages of processing an image whose durations are recorded
+STAGES = ('stat', 'decode', 'downscale', 'detect', 'match')
+# Minimum seconds between updates of the progress line
+PROGRESS_INTERVAL = 0.25
+# Stage durations are counted in log-spaced bins from DURATION_MIN to DURATION_MAX seconds, so their
+# percentiles are within 5% whatever the number of images
+DURATION_MIN = 1e-6
+DURATION_MAX = 1e4
+DURATION_BINS_PER_DECADE = 50
+
 # Globals for image scanning algorithms
 
+# cv2.imread flags that decode JPEG images at a reduced size in the DCT domain, by factor
+REDUCED_GRAYSCALE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+}
+
 # Lowe ratio, essentially used to determine if two keypoints match
 LOWE_RATIO = 0.7
-# Requires OPENCV_ENABLE_NONFREE=ON when compiling OpenCV
-_SIFT = cv2.SIFT_create()
-# ORB detector does not perform well, but it is under a free license
-#_ORB = cv2.ORB_create()
+# Maximum number of keypoints kept by the ORB detector
+ORB_FEATURES = 2000
 # Brute Force matcher has limited number of descriptors:
 # cv2.error: OpenCV(4.5.0) ../modules/features2d/src/matchers.cpp:860: error: (-215:Assertion failed) trainDescCollection[iIdx].rows < IMGIDX_ONE in function 'knnMatchImpl'
 # So we hardcode limit here:
 #BF_IMGIDX_SHIFT = 18
 #BF_IMGIDX_ONE = 1 << BF_IMGIDX_SHIFT
 #_BF = cv2.BFMatcher()
-FLANN_KNN_MATCHES = 2 # For _FLANN.knnMatch
-FLANN_INDEX_KDTREE = 0
+FLANN_KNN_MATCHES = 2 # For FlannBasedMatcher.knnMatch
+# Nearest neighbours of each descriptor considered when grouping a library, so images with several
+# copies still find them
+GROUP_KNN_MATCHES = 16
+FLANN_INDEX_KDTREE = 1 # 0 is FLANN_INDEX_LINEAR, a brute force search
+FLANN_INDEX_LSH = 6
 flann_index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+# For binary descriptors, which are compared by Hamming distance
+flann_lsh_index_params = dict(algorithm=FLANN_INDEX_LSH,
+                              table_number=6,
+                              key_size=12,
+                              multi_probe_level=1)
 flann_search_params = dict(checks=50) # or pass empty dictionary
-_FLANN = cv2.FlannBasedMatcher(flann_index_params, flann_search_params)
+# How scanned descriptors are matched against the reference descriptor:
+# pairwise: train a FLANN index on every scanned image and query it with the reference
+# indexed: train a FLANN index on the reference once and query it with every scanned image
+MATCH_MODES = ('pairwise', 'indexed')
+
+# Globals for the coarse-to-fine cascade
+
+# Maximum length of the larger dimension in the coarse pass
+CASCADE_MAX_LENGTH = 200
+# Maximum number of keypoints per image in the coarse pass
+CASCADE_FEATURES = 300
+# Number of images per query from the coarse pass that are scored again at full size
+CASCADE_REFINE = 4 * NTOP
+# Maximum reprojection error of RANSAC homography inliers, in pixels
+RANSAC_REPROJ_THRESHOLD = 5.0
+# Minimum number of matches needed to fit a homography
+RANSAC_MIN_MATCHES = 4
+
+# Globals for compact descriptors
+
+# Default number of dimensions of PCA-reduced descriptors
+PCA_DIMS = 64
+# Percentiles of the PCA projections mapped to the uint8 range by --quantize
+QUANTIZE_PERCENTILES = (0.1, 99.9)
+
+# Globals for the descriptor cache
+
+# Name of the file containing all packed descriptors
+CACHE_BLOB_NAME = 'descriptors.bin'
+# Name of the file containing the offset table into the blob
+CACHE_INDEX_NAME = 'index.json'
+# Name of the file locked by processes writing to the cache
+CACHE_LOCK_NAME = 'lock'
+# Version of the offset table format
+CACHE_VERSION = 2
+# Every descriptor in the blob starts at a multiple of this, so memory-mapped arrays are aligned
+CACHE_ALIGNMENT = 16
+
+# Globals for the global descriptor (VLAD) index
+
+# Number of visual words in the vocabulary
+VLAD_VOCABULARY_SIZE = 64
+# Number of dimensions the VLAD vectors are reduced to with PCA
+VLAD_PCA_DIMS = 256
+# Number of images whose descriptors are used to train the vocabulary and PCA
+VLAD_TRAIN_IMAGES = 2000
+# Maximum number of descriptors used for k-means clustering
+VLAD_TRAIN_DESCRIPTORS = 200000
+# Number of candidates selected by the index for keypoint matching
+VLAD_CANDIDATES = 300
+
+# Globals for perceptual hashing
+
+# Maximum length of the larger dimension when decoding images for hashing
+HASH_MAX_LENGTH = 64
+# Default maximum Hamming distance between hashes of near duplicates
+HASH_MAX_DISTANCE = 10
+
+# Globals for library-wide similarity grouping
+
+# Default minimum number of good matches between two images to group them
+DUPES_MIN_GOOD = 50
+# Default maximum number of descriptors in the FLANN index of one shard
+DUPES_SHARD_DESCRIPTORS = 2000000
+
+# Globals for the query server
+
+# Default address to listen on
+SERVE_ADDRESS = '127.0.0.1:8390'
+# Default number of seconds between rescans of the library
+SERVE_RESCAN_INTERVAL = 60
+# Number of library images scored per task in the server thread pool
+SERVE_CHUNK_SIZE = 256
+# Maximum size of an uploaded query image
+SERVE_MAX_UPLOAD = 256 * 1024 * 1024
 
 # Globals for a worker in the process pool
 
-# Loaded reference descriptor
-_REFERENCE_DES: np.ndarray = None
-# Maximum length of the larger dimension when downscaling images
-_MAX_LENGTH: int = None
+# Loaded reference descriptors, one per query image. They are views into _REFERENCE_SHM
+_REFERENCE_DESCRIPTORS: list = None
+# Shared memory containing the reference descriptors, which must be kept open
+_REFERENCE_SHM: shared_memory.SharedMemory = None
+# Keypoint coordinates of _REFERENCE_DESCRIPTORS, for geometric verification
+_REFERENCE_POINTS: list = None
+# FLANN indexes of _REFERENCE_DESCRIPTORS, or None when using the pairwise match mode
+_REFERENCE_INDEXES: list = None
+# Parameters for computing descriptors
+_OPTIONS: 'DescriptorOptions' = None
+# Detectors and FLANN matchers by engine name, created on first use in each process or thread
+_DETECTORS = threading.local()
+_MATCHERS = threading.local()
+# Loaded PCA bases by path
+_PCA_BASES = dict()
+# Read-only descriptor cache, or None if caching is disabled
+_CACHE: 'DescriptorCache' = None
+# VLAD vocabulary and PCA projection for building the global index
+_VOCABULARY: np.ndarray = None
+_PCA: tuple = None
+# Name of the perceptual hash function in HASH_FUNCTIONS
+_HASH_NAME: str = None
+# Descriptor options compared by "bench compact"
+_VARIANTS = list()
+# Durations by stage of the image being processed by this thread, or None if not recorded
+_STAGE_TIMES = threading.local()
+# Path and decoded image of the video frame being processed by this thread
+_CURRENT_FRAME = threading.local()
+# Opened archives by path, least recently used first, as CachedArchive
+_ARCHIVES = dict()
+_ARCHIVES_LOCK = threading.Lock()
 
 # Base code for image searching
 
@@ -57,6 +337,18 @@ class _InvalidComputation(Exception):
     pass
 
 
+@contextlib.contextmanager
+def timed(stage):
+    # Adds the duration of the block to the stage durations of the current image, if recorded
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        times = getattr(_STAGE_TIMES, 'times', None)
+        if times is not None:
+            times[stage] = times.get(stage, 0.0) + time.perf_counter() - start
+
+
 def downscale_img(img, max_length):
     height, width = img.shape[:2]
     if height < max_length and width < max_length:
@@ -66,51 +358,1329 @@ def downscale_img(img, max_length):
         new_dim = (int(width / float(height) * max_length), max_length)
     else:
         new_dim = (max_length, int(height / float(width) * max_length))
-    return cv2.resize(img, new_dim, interpolation=cv2.INTER_AREA)
+    with timed('downscale'):
+        return cv2.resize(img, new_dim, interpolation=cv2.INTER_AREA)
+
+
+def create_akaze():
+    # AKAZE moved to the contrib modules in OpenCV 5
+    if hasattr(cv2, 'AKAZE_create'):
+        return cv2.AKAZE_create()
+    return cv2.xfeatures2d.AKAZE_create()
+
+
+class Engine(typing.NamedTuple):
+    # Keypoint detector and descriptor extractor, and how to index its descriptors
+
+    create: typing.Callable
+    index_params: dict
+    # Whether FLANN indexes return squared distances, which need a squared Lowe ratio
+    squared_distances: bool
+
+
+ENGINES = {
+    # Requires OPENCV_ENABLE_NONFREE=ON when compiling OpenCV before 4.4
+    'sift': Engine(cv2.SIFT_create, flann_index_params, True),
+    # ORB detector does not perform as well, but it is under a free license, and its binary
+    # descriptors are 4x smaller than SIFT and faster to match
+    'orb': Engine(lambda: cv2.ORB_create(nfeatures=ORB_FEATURES), flann_lsh_index_params, False),
+    'akaze': Engine(create_akaze, flann_lsh_index_params, False),
+}
 
 
-def compute_descriptor(img_path, max_length):
-    img = cv2.imread(str(img_path), 0)
+def get_detector(engine):
+    detector = getattr(_DETECTORS, engine, None)
+    if detector is None:
+        detector = ENGINES[engine].create()
+        setattr(_DETECTORS, engine, detector)
+    return detector
+
+
+def get_matcher(engine):
+    matcher = getattr(_MATCHERS, engine, None)
+    if matcher is None:
+        matcher = cv2.FlannBasedMatcher(ENGINES[engine].index_params, flann_search_params)
+        setattr(_MATCHERS, engine, matcher)
+    return matcher
+
+
+class DescriptorOptions(typing.NamedTuple):
+    # Parameters that determine the descriptor computed for an image
+
+    # Maximum length of the larger dimension when downscaling images
+    max_length: int
+    # Whether to always decode images at full resolution before downscaling
+    full_decode: bool = False
+    # Name of the engine in ENGINES
+    engine: str = 'sift'
+    # Maximum number of keypoints with the strongest response to keep, or 0 to keep all
+    nfeatures: int = 0
+    # Whether to convert descriptors to RootSIFT
+    rootsift: bool = False
+    # Path to the PCA basis file to project descriptors with, or an empty string
+    pca: str = ''
+    # Digest of the PCA basis file contents
+    pca_digest: str = ''
+    # Whether to quantize PCA-projected descriptors to uint8
+    quantize: bool = False
+
+    @property
+    def variant(self):
+        # Identifies the parameters, so the cache never mixes them
+        variant = f'{self.engine}-{self.max_length}'
+        if self.full_decode:
+            variant += '-full'
+        if self.nfeatures:
+            variant += f'-n{self.nfeatures}'
+        if self.rootsift:
+            variant += '-root'
+        if self.pca:
+            variant += f'-pca{self.pca_digest}'
+        if self.quantize:
+            variant += '-u8'
+        return variant
+
+
+def jpeg_dimensions(img_file):
+    # Returns (width, height) from the frame header of a JPEG file object, or None if it is not a
+    # JPEG file. Only the marker segments before the frame header are read.
+    if img_file.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        marker = img_file.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        while marker[1] == 0xff:
+            # Fill bytes before the marker
+            marker = marker[1:] + img_file.read(1)
+            if len(marker) < 2:
+                return None
+        code = marker[1]
+        if code == 0x01 or 0xd0 <= code <= 0xd7:
+            # Markers without a segment
+            continue
+        if code in (0xd9, 0xda):
+            # End of image or start of scan before any frame header
+            return None
+        length = int.from_bytes(img_file.read(2), 'big')
+        if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+            header = img_file.read(5)
+            if len(header) < 5:
+                return None
+            return int.from_bytes(header[3:5], 'big'), int.from_bytes(header[1:3], 'big')
+        if length < 2:
+            return None
+        img_file.seek(length - 2, os.SEEK_CUR)
+
+
+def reduced_decode_flag(dimensions, max_length):
+    # Returns the largest reduced decoding flag that keeps the larger dimension at least
+    # max_length, so the final downscale still has enough pixels to work with
+    if dimensions is None:
+        return cv2.IMREAD_GRAYSCALE
+    larger = max(dimensions)
+    for factor, flag in REDUCED_GRAYSCALE_FLAGS.items():
+        if larger // factor >= max_length:
+            return flag
+    return cv2.IMREAD_GRAYSCALE
+
+
+def decode_image(data, options):
+    # Like load_image, but for an image file's contents in memory
+    flag = cv2.IMREAD_GRAYSCALE
+    with timed('decode'):
+        if not options.full_decode:
+            flag = reduced_decode_flag(jpeg_dimensions(io.BytesIO(data)), options.max_length)
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
     if img is None:
         raise _InvalidComputation('Not a valid image')
+    return downscale_img(img, options.max_length)
+
 
-    img = downscale_img(img, max_length)
+class TarArchive:
+    # Uncompressed tar archive with the same reading interface as zipfile.ZipFile. The member
+    # headers are read once, and members are then read directly at their offsets.
 
-    #kp, des = _ORB.detectAndCompute(img, None)
-    kp, des = _SIFT.detectAndCompute(img, None)
-    #kp, des = _SURF.detectAndCompute(img, None)
-    #print(img_path, des.dtype, des.shape)
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            with tarfile.open(fileobj=self._file, mode='r:') as tar:
+                self._members = {
+                    info.name: (info.offset_data, info.size)
+                    for info in tar
+                    if info.isfile() and not info.issparse()
+                }
+        except BaseException:
+            self._file.close()
+            raise
+
+    def namelist(self):
+        return list(self._members)
+
+    def read(self, name, length=None):
+        offset, size = self._members[name]
+        if length is not None:
+            size = min(size, length)
+        return os.pread(self._file.fileno(), size, offset)
+
+    def close(self):
+        self._file.close()
+
+
+def open_archive(archive_path):
+    if ARCHIVE_EXTENSIONS[os.path.splitext(archive_path)[1].lower()] == 'zip':
+        return zipfile.ZipFile(archive_path)
+    return TarArchive(archive_path)
+
+
+def is_archive(path):
+    return os.path.splitext(path)[1].lower() in ARCHIVE_EXTENSIONS and os.path.isfile(path)
+
+
+def split_archive_path(img_path):
+    # Returns (archive path, member name) for the path of an image inside an archive, or None
+    img_path = str(img_path)
+    index = img_path.find(ARCHIVE_SEPARATOR)
+    while index >= 0:
+        if is_archive(img_path[:index]):
+            return img_path[:index], img_path[index + len(ARCHIVE_SEPARATOR):]
+        index = img_path.find(ARCHIVE_SEPARATOR, index + 1)
+    return None
+
+
+class CachedArchive:
+    # Open archive of _ARCHIVES, with the number of threads reading it, so that an archive evicted
+    # while it is read is only closed by its last reader
+
+    def __init__(self, stat, archive):
+        self.stat = stat
+        self.archive = archive
+        self.readers = 0
+        self.evicted = False
+
+    def evict(self):
+        # Called with _ARCHIVES_LOCK held
+        self.evicted = True
+        if not self.readers:
+            self.archive.close()
+
+
+def read_archive_member(archive_path, name):
+    # Returns the contents of an archive member. Archives stay open for reading their other
+    # members, and are reopened when they change.
+    stat = stat_key(archive_path)
+    with _ARCHIVES_LOCK:
+        entry = _ARCHIVES.pop(archive_path, None)
+        if entry is not None and entry.stat != stat:
+            entry.evict()
+            entry = None
+        if entry is None:
+            entry = CachedArchive(stat, open_archive(archive_path))
+        _ARCHIVES[archive_path] = entry
+        entry.readers += 1
+        while len(_ARCHIVES) > ARCHIVE_CACHE_SIZE:
+            _ARCHIVES.pop(next(iter(_ARCHIVES))).evict()
+    try:
+        return entry.archive.read(name)
+    finally:
+        with _ARCHIVES_LOCK:
+            entry.readers -= 1
+            if entry.evicted and not entry.readers:
+                entry.archive.close()
+
+
+def open_image(img_path):
+    # Returns a binary file object of an image file or of an image inside an archive
+    archive_member = split_archive_path(img_path)
+    if archive_member is None:
+        return open(img_path, 'rb')
+    return io.BytesIO(read_archive_member(*archive_member))
+
+
+class FrameSampling(typing.NamedTuple):
+    # How frames are sampled from videos
+
+    # Seconds between sampled frames
+    interval: float = VIDEO_FRAME_INTERVAL
+    # Minimum mean absolute difference between thumbnails, from 0 to 1, to sample a frame on a
+    # scene change instead of at the interval, or None
+    scene_threshold: float = None
+
+
+def split_video_path(img_path):
+    # Returns (video path, start, end) for a video segment path, or (video path, timestamp, None)
+    # for a video frame path, or None for other paths
+    img_path = str(img_path)
+    index = img_path.rfind(VIDEO_FRAGMENT)
+    if index < 0 or os.path.splitext(img_path[:index])[1].lower() not in VIDEO_EXTENSIONS:
+        return None
+    try:
+        times = [float(seconds) for seconds in img_path[index + len(VIDEO_FRAGMENT):].split(',')]
+    except ValueError:
+        return None
+    if len(times) > 2 or not os.path.isfile(img_path[:index]):
+        return None
+    return img_path[:index], times[0], times[1] if len(times) == 2 else None
+
+
+def open_video(video_path):
+    # Returns the capture of a video and its frame rate
+    capture = cv2.VideoCapture(video_path)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    if not capture.isOpened() or fps <= 0:
+        capture.release()
+        raise _InvalidComputation('Not a valid video')
+    return capture, fps
+
+
+def list_video_segments(video_path, segment_seconds):
+    # Returns the paths of the segments of a video, which are scanned separately
+    try:
+        capture, fps = open_video(video_path)
+    except _InvalidComputation as exc:
+        error_msg(f'Skipping video with error "{exc}":', video_path)
+        return list()
+    duration = capture.get(cv2.CAP_PROP_FRAME_COUNT) / fps
+    capture.release()
+    segments = list()
+    start = 0.0
+    while start < duration:
+        end = min(start + segment_seconds, duration)
+        segments.append(f'{video_path}{VIDEO_FRAGMENT}{start:.3f},{end:.3f}')
+        start = end
+    return segments
+
+
+def thumbnail_distance(thumbnail1, thumbnail2):
+    return float(np.mean(cv2.absdiff(thumbnail1, thumbnail2))) / 255
+
+
+def sample_frames(video_path, start, end, sampling):
+    # Yields (timestamp, grayscale frame) of the sampled frames from start to end seconds, one at a
+    # time. Frames between samples are only grabbed, or seeked over if there are many.
+    capture, fps = open_video(video_path)
+    try:
+        first = round(start * fps)
+        last = round(end * fps)
+        interval = sampling.interval
+        if sampling.scene_threshold is not None:
+            interval = VIDEO_SCENE_INTERVAL
+        step = max(1, round(interval * fps))
+        capture.set(cv2.CAP_PROP_POS_FRAMES, first)
+        position = first
+        previous = None
+        for target in range(first, last, step):
+            if target - position > VIDEO_SEEK_SECONDS * fps:
+                capture.set(cv2.CAP_PROP_POS_FRAMES, target)
+                position = target
+            while position < target:
+                if not capture.grab():
+                    return
+                position += 1
+            ok, frame = capture.read()
+            if not ok:
+                return
+            position += 1
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            if sampling.scene_threshold is not None:
+                thumbnail = cv2.resize(frame, VIDEO_SCENE_THUMBNAIL, interpolation=cv2.INTER_AREA)
+                changed = (previous is None or
+                           thumbnail_distance(previous, thumbnail) >= sampling.scene_threshold)
+                previous = thumbnail
+                if not changed:
+                    continue
+            yield target / fps, frame
+    finally:
+        capture.release()
+
+
+def load_frame(video_path, timestamp):
+    # Returns a single frame of a video in grayscale, using the frame being processed if it is
+    if getattr(_CURRENT_FRAME, 'path', None) == f'{video_path}{VIDEO_FRAGMENT}{timestamp:.3f}':
+        return _CURRENT_FRAME.img
+    capture, fps = open_video(video_path)
+    try:
+        capture.set(cv2.CAP_PROP_POS_FRAMES, round(timestamp * fps))
+        ok, frame = capture.read()
+    finally:
+        capture.release()
+    if not ok:
+        raise _InvalidComputation('Timestamp is not in the video')
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+
+def load_image(img_path, options):
+    # Returns the image in grayscale, downscaled according to options
+    video_frame = split_video_path(img_path)
+    if video_frame is not None:
+        video_path, timestamp, end = video_frame
+        if end is not None:
+            raise _InvalidComputation('A video segment is not an image')
+        with timed('decode'):
+            img = load_frame(video_path, timestamp)
+        return downscale_img(img, options.max_length)
+    archive_member = split_archive_path(img_path)
+    if archive_member is not None:
+        with timed('decode'):
+            data = read_archive_member(*archive_member)
+        return decode_image(data, options)
+    flag = cv2.IMREAD_GRAYSCALE
+    with timed('decode'):
+        if not options.full_decode:
+            try:
+                with open(img_path, 'rb') as img_file:
+                    flag = reduced_decode_flag(jpeg_dimensions(img_file), options.max_length)
+            except OSError:
+                # Let imread report the error
+                pass
+        img = cv2.imread(str(img_path), flag)
+    if img is None:
+        raise _InvalidComputation('Not a valid image')
+    return downscale_img(img, options.max_length)
+
+
+def file_digest(path):
+    with open(path, 'rb') as digest_file:
+        return hashlib.sha1(digest_file.read()).hexdigest()[:12]
+
+
+def load_pca_basis(path):
+    # Returns the PCA basis file contents as a dict, loaded once per process
+    basis = _PCA_BASES.get(path)
+    if basis is None:
+        with np.load(path) as basis_file:
+            basis = _PCA_BASES[path] = dict(basis_file)
+    return basis
+
+
+def compact_descriptor(des, options):
+    # Applies RootSIFT, PCA projection and quantization as set in options
+    if options.rootsift:
+        des = np.sqrt(des / np.maximum(des.sum(axis=1, keepdims=True), 1e-7))
+    if options.pca:
+        basis = load_pca_basis(options.pca)
+        des = (des - basis['mean']) @ basis['basis']
+        if options.quantize:
+            # One scale for all dimensions, so distances shrink uniformly and ratios are kept
+            des = np.clip(np.rint((des - basis['quantize_low']) * basis['quantize_scale']), 0, 255)
+            des = des.astype(np.uint8)
+    return np.ascontiguousarray(des, dtype=np.uint8 if options.quantize else des.dtype)
+
+
+def matchable(des, engine):
+    # KD-tree indexes only accept float32 descriptors, so quantized ones are converted. Because
+    # quantization uses one scale for all dimensions, the ratio test is unaffected.
+    if ENGINES[engine].squared_distances and des.dtype != np.float32:
+        return des.astype(np.float32)
+    return des
+
+
+def detect_keypoints(img, options):
+    # Returns the keypoint coordinates of a loaded image as an Nx2 array and their descriptor
+    with timed('detect'):
+        kp, des = get_detector(options.engine).detectAndCompute(img, None)
 
     if not kp:
         raise _InvalidComputation('Could not find any keypoints')
     if des is None:
         raise _InvalidComputation('descriptor is None')
 
-    return des
+    points = np.array([keypoint.pt for keypoint in kp], dtype=np.float32)
+    if options.nfeatures and len(kp) > options.nfeatures:
+        strongest = np.argsort([-keypoint.response for keypoint in kp])[:options.nfeatures]
+        points = points[strongest]
+        des = des[strongest]
+    with timed('detect'):
+        return points, compact_descriptor(des, options)
+
+
+def compute_keypoints(img_path, options):
+    return detect_keypoints(load_image(img_path, options), options)
+
+
+def compute_descriptor(img_path, options):
+    return compute_keypoints(img_path, options)[1]
+
 
+def source_file(img_path):
+    # Returns the path of the file containing an image, which is the archive or video for images
+    # inside one
+    video_frame = split_video_path(img_path)
+    if video_frame is not None:
+        return video_frame[0]
+    archive_member = split_archive_path(img_path)
+    if archive_member is not None:
+        return archive_member[0]
+    return img_path
 
-def get_good_matches(des1, des2):
+
+def stat_key(img_path):
+    # Images inside an archive or video are considered modified whenever the file is
+    with timed('stat'):
+        stat = os.stat(source_file(img_path))
+    return stat.st_size, stat.st_mtime_ns
+
+
+class DescriptorCache:
+    # Persistent descriptor store keyed by path, size, mtime and descriptor variant.
+    # All descriptors are packed into one blob file, and an offset table maps each key to its
+    # location. The blob is memory-mapped when reading, so cached descriptors are not copied.
+    # Several processes may write to the cache: appending to the blob and replacing the offset
+    # table or the blob happen under an exclusive lock of the cache directory, and saving merges
+    # the entries of the other writers. Workers open it read-only.
+
+    def __init__(self, cache_dir, writable=False):
+        self.cache_dir = Path(cache_dir)
+        self.writable = writable
+        self._blob_path = self.cache_dir / CACHE_BLOB_NAME
+        self._index_path = self.cache_dir / CACHE_INDEX_NAME
+        # Maps "variant:path" to [size, mtime_ns, offset, rows, cols, dtype]
+        self._entries = dict()
+        # Inode of the blob the offsets refer to, which changes when the cache is compacted
+        self._blob_inode = None
+        self._mmap = None
+        self._append_file = None
+        self._lock_file = None
+        # Keys added by this instance, with the inode of the blob they were written to, and keys
+        # removed by it, to merge into the offset table on disk when saving
+        self._added = dict()
+        self._removed = set()
+        if writable:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._lock_file = (self.cache_dir / CACHE_LOCK_NAME).open('a')
+        self._entries, self._blob_inode = self._read_index()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _read_index(self):
+        if not self._index_path.exists():
+            return dict(), None
+        with self._index_path.open() as index_file:
+            index = json.load(index_file)
+        if index.get('version') != CACHE_VERSION:
+            error_msg('Ignoring descriptor cache with unknown version:', self._index_path)
+            return dict(), None
+        return index['entries'], index.get('blob_inode')
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _current_blob_inode(self):
+        try:
+            return self._blob_path.stat().st_ino
+        except FileNotFoundError:
+            return None
+
+    def _get_mmap(self):
+        if self._mmap is None and self._blob_path.exists() and self._blob_path.stat().st_size:
+            with self._blob_path.open('rb') as blob_file:
+                # The offsets do not apply to a blob that was compacted after reading them
+                if self._blob_inode is not None and os.fstat(
+                        blob_file.fileno()).st_ino != self._blob_inode:
+                    return None
+                self._mmap = mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _read_entry(self, entry):
+        _, _, offset, rows, cols, dtype = entry
+        end = offset + rows * cols * np.dtype(dtype).itemsize
+        blob = self._get_mmap()
+        if blob is not None and end > len(blob):
+            # Entry was appended after the blob was mapped. Arrays returned earlier keep the
+            # previous mapping alive.
+            self._mmap = None
+            blob = self._get_mmap()
+        if blob is None or end > len(blob):
+            return None
+        return np.frombuffer(blob, dtype=dtype, count=rows * cols, offset=offset).reshape(
+            rows, cols)
+
+    def lookup(self, img_path, variant, stat):
+        # Returns the cached descriptor, or None if missing or stale
+        entry = self._entries.get(f'{variant}:{os.path.abspath(img_path)}')
+        if entry is None or tuple(entry[:2]) != tuple(stat):
+            return None
+        return self._read_entry(entry)
+
+    def add(self, img_path, variant, stat, des):
+        assert self.writable
+        des = np.ascontiguousarray(des)
+        with self._locked():
+            blob_inode = self._current_blob_inode()
+            if self._append_file is None or os.fstat(
+                    self._append_file.fileno()).st_ino != blob_inode:
+                # The blob was created or compacted by another writer
+                if self._append_file is not None:
+                    self._append_file.close()
+                self._append_file = self._blob_path.open('ab')
+                blob_inode = os.fstat(self._append_file.fileno()).st_ino
+            # The end of the blob, including what other writers appended
+            offset = os.fstat(self._append_file.fileno()).st_size
+            padding = -offset % CACHE_ALIGNMENT
+            offset += padding
+            self._append_file.write(bytes(padding) + des.tobytes())
+            self._append_file.flush()
+        key = f'{variant}:{os.path.abspath(img_path)}'
+        self._entries[key] = [*stat, offset, des.shape[0], des.shape[1], des.dtype.str]
+        self._added[key] = blob_inode
+        self._removed.discard(key)
+
+    def invalidate(self, paths):
+        # Drops entries for the given files and everything under the given directories
+        prefixes = tuple(os.path.abspath(path) for path in paths)
+        removed = 0
+        for key in list(self._entries):
+            entry_path = key.split(':', 1)[1]
+            if any(entry_path == prefix or entry_path.startswith(prefix.rstrip(os.sep) + os.sep)
+                   or entry_path.startswith(prefix + ARCHIVE_SEPARATOR)
+                   or entry_path.startswith(prefix + VIDEO_FRAGMENT) for prefix in prefixes):
+                del self._entries[key]
+                self._added.pop(key, None)
+                self._removed.add(key)
+                removed += 1
+        return removed
+
+    def compact(self):
+        # Drops entries for deleted or modified files and rewrites the blob without unused space
+        assert self.writable
+        with self._locked():
+            self._merge_index()
+            if self._append_file is not None:
+                self._append_file.close()
+                self._append_file = None
+            new_entries = dict()
+            removed = 0
+            tmp_blob_path = self._blob_path.with_suffix('.tmp')
+            with tmp_blob_path.open('wb') as tmp_blob:
+                for key, entry in self._entries.items():
+                    try:
+                        current_stat = stat_key(key.split(':', 1)[1])
+                    except OSError:
+                        current_stat = None
+                    des = self._read_entry(entry)
+                    if current_stat != tuple(entry[:2]) or des is None:
+                        removed += 1
+                        continue
+                    tmp_blob.write(bytes(-tmp_blob.tell() % CACHE_ALIGNMENT))
+                    new_entries[key] = [*entry[:2], tmp_blob.tell(), *entry[3:]]
+                    tmp_blob.write(des.tobytes())
+            # Release the last view into the mmap so it can be closed
+            des = None
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            os.replace(tmp_blob_path, self._blob_path)
+            self._entries = new_entries
+            self._blob_inode = self._current_blob_inode()
+            self._write_index()
+        return removed
+
+    def _merge_index(self):
+        # Applies the changes of this instance to the offset table on disk, which may have
+        # entries of other writers, and takes the result. Must hold the lock.
+        entries, blob_inode = self._read_index()
+        current_inode = self._current_blob_inode()
+        if blob_inode is not None and blob_inode != current_inode:
+            # The table on disk refers to a blob that was since removed
+            entries = dict()
+        for key in self._removed:
+            entries.pop(key, None)
+        for key, key_blob_inode in self._added.items():
+            # Entries written to a blob that was compacted since are lost
+            if key_blob_inode == current_inode:
+                entries[key] = self._entries[key]
+        if self._blob_inode != current_inode and self._mmap is not None:
+            self._mmap = None
+        self._entries = entries
+        self._blob_inode = current_inode
+        self._added = dict()
+        self._removed = set()
+
+    def _write_index(self):
+        tmp_index_path = self._index_path.with_suffix('.tmp')
+        with tmp_index_path.open('w') as index_file:
+            json.dump(
+                {
+                    'version': CACHE_VERSION,
+                    'blob_inode': self._blob_inode,
+                    'entries': self._entries
+                }, index_file)
+        os.replace(tmp_index_path, self._index_path)
+
+    def save(self):
+        if not self._added and not self._removed:
+            return
+        assert self.writable
+        with self._locked():
+            self._merge_index()
+            self._write_index()
+
+    def close(self):
+        if self.writable:
+            self.save()
+            self._lock_file.close()
+            self._lock_file = None
+        if self._append_file is not None:
+            self._append_file.close()
+            self._append_file = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+def get_good_matches(des1, des2, engine='sift'):
     # Because of https://github.com/opencv/opencv/issues/10548
     if des2.shape[0] < FLANN_KNN_MATCHES:
         raise _InvalidComputation('train descriptor has too few entries')
 
-    matches = _FLANN.knnMatch(des1, des2, k=FLANN_KNN_MATCHES)
+    matches = get_matcher(engine).knnMatch(matchable(des1, engine),
+                                           matchable(des2, engine),
+                                           k=FLANN_KNN_MATCHES)
     if not matches:
         raise _InvalidComputation('No matches found')
-    if len(matches[0]) != 2:
-        raise _InvalidComputation(f'Matches columns must have 2 entries, got {len(matches[0])}')
 
     # ratio test as per Lowe's paper
     #good = list()
     ngood = 0
-    for m, n in matches:
-        if m.distance < LOWE_RATIO * n.distance:
-            #good.append(m)
+    for pair in matches:
+        # LSH indexes may find fewer than 2 neighbours for a descriptor
+        if len(pair) == FLANN_KNN_MATCHES and pair[0].distance < LOWE_RATIO * pair[1].distance:
+            #good.append(pair[0])
             ngood += 1
 
     return ngood
 
 
+def good_match_pairs(des1, des2, engine='sift'):
+    # Like get_good_matches, but returns the indices into des1 and des2 of the good matches as an
+    # Nx2 array
+    if des2.shape[0] < FLANN_KNN_MATCHES:
+        raise _InvalidComputation('train descriptor has too few entries')
+    matches = get_matcher(engine).knnMatch(matchable(des1, engine),
+                                           matchable(des2, engine),
+                                           k=FLANN_KNN_MATCHES)
+    pairs = [(pair[0].queryIdx, pair[0].trainIdx) for pair in matches
+             if len(pair) == FLANN_KNN_MATCHES and pair[0].distance < LOWE_RATIO * pair[1].distance]
+    return np.array(pairs, dtype=np.int32).reshape(-1, 2)
+
+
+def count_inliers(points1, points2, pairs):
+    # Returns the number of matches consistent with a RANSAC homography between the two images
+    if len(pairs) < RANSAC_MIN_MATCHES:
+        return 0
+    _, mask = cv2.findHomography(points1[pairs[:, 0]], points2[pairs[:, 1]], cv2.RANSAC,
+                                 RANSAC_REPROJ_THRESHOLD)
+    if mask is None:
+        return 0
+    return int(np.count_nonzero(mask))
+
+
+def build_reference_index(des, engine='sift'):
+    if des.shape[0] < FLANN_KNN_MATCHES:
+        raise _InvalidComputation('reference descriptor has too few entries')
+    # NOTE: The index does not copy des, so the caller must keep it alive
+    return cv2.flann_Index(des, ENGINES[engine].index_params)
+
+
+def get_good_matches_indexed(index, des, engine='sift'):
+    # Matches every scanned descriptor against the pre-built reference index, with the Lowe
+    # ratio test vectorized over the distance arrays
+    indices, dists = index.knnSearch(matchable(des, engine),
+                                     FLANN_KNN_MATCHES,
+                                     params=flann_search_params)
+    ratio = LOWE_RATIO**2 if ENGINES[engine].squared_distances else LOWE_RATIO
+    # LSH indexes mark missing neighbours with a negative index
+    good = (dists[:, 0] < ratio * dists[:, 1]) & (indices[:, 1] >= 0)
+    return int(np.count_nonzero(good))
+
+
+def score_descriptor(scan_des):
+    # Returns the number of good matches against every query image
+    engine = _OPTIONS.engine
+    with timed('match'):
+        if _REFERENCE_INDEXES is None:
+            return [
+                get_good_matches(ref_des, scan_des, engine) for ref_des in _REFERENCE_DESCRIPTORS
+            ]
+        return [get_good_matches_indexed(index, scan_des, engine) for index in _REFERENCE_INDEXES]
+
+
+def ranking_agreement(scores_a, scores_b, ntop):
+    # Compares two rankings of the same images given as {path: score} dicts.
+    # Returns the overlap of the top ntop results and the Spearman rank correlation.
+    paths = sorted(scores_a.keys() & scores_b.keys())
+    if len(paths) < 2:
+        return 0.0, 0.0
+    top_a = set(sorted(paths, key=scores_a.get)[-ntop:])
+    top_b = set(sorted(paths, key=scores_b.get)[-ntop:])
+    ranks_a = np.argsort(np.argsort([scores_a[path] for path in paths]))
+    ranks_b = np.argsort(np.argsort([scores_b[path] for path in paths]))
+    spearman = np.corrcoef(ranks_a, ranks_b)[0, 1]
+    return len(top_a & top_b) / len(top_a), float(spearman)
+
+
+def vlad_features(des, engine):
+    # Binary descriptors are compared by Hamming distance, which is the squared L2 distance between
+    # their bits, so they are clustered and aggregated bit by bit rather than byte by byte
+    if not ENGINES[engine].squared_distances:
+        return np.unpackbits(des, axis=1).astype(np.float32)
+    return des.astype(np.float32, copy=False)
+
+
+def compute_vlad(des, vocabulary, engine):
+    # Aggregates local descriptors into one VLAD vector, with intra- and power normalization
+    des = vlad_features(des, engine)
+    # Nearest visual word by squared L2 distance (|d|^2 is constant per row, so it is omitted)
+    words = np.argmin((vocabulary**2).sum(axis=1) - 2 * des @ vocabulary.T, axis=1)
+    vlad = np.zeros_like(vocabulary)
+    np.add.at(vlad, words, des - vocabulary[words])
+    norms = np.linalg.norm(vlad, axis=1, keepdims=True)
+    vlad /= np.maximum(norms, 1e-12)
+    vlad = vlad.ravel()
+    vlad = np.sign(vlad) * np.sqrt(np.abs(vlad))
+    return vlad / max(np.linalg.norm(vlad), 1e-12)
+
+
+def project_vlad(vlad, pca):
+    # Reduces VLAD vectors with a whitened PCA basis and renormalizes them
+    mean, basis = pca
+    reduced = (vlad - mean) @ basis
+    return reduced / np.maximum(np.linalg.norm(reduced, axis=-1, keepdims=True), 1e-12)
+
+
+def train_vocabulary(descriptors, size, engine):
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1e-3)
+    _, _, centers = cv2.kmeans(vlad_features(descriptors, engine), size, None, criteria, 1,
+                               cv2.KMEANS_PP_CENTERS)
+    return centers
+
+
+def train_pca(vlads, dims):
+    mean = vlads.mean(axis=0)
+    _, singular_values, vt = np.linalg.svd(vlads - mean, full_matrices=False)
+    dims = min(dims, len(singular_values))
+    # Whitening equalizes the contribution of each component
+    basis = vt[:dims].T / np.maximum(singular_values[:dims] / np.sqrt(len(vlads)), 1e-6)
+    return mean.astype(np.float32), basis.astype(np.float32)
+
+
+class GlobalIndex:
+    # Index of one compact global vector per image. Stored as a directory of .npy files so the
+    # vectors can be memory-mapped when searching.
+
+    def __init__(self, options, vocabulary, pca, vectors, paths):
+        self.options = options
+        self.vocabulary = vocabulary
+        self.pca = pca
+        self.vectors = vectors
+        self.paths = paths
+
+    @classmethod
+    def load(cls, index_dir):
+        index_dir = Path(index_dir)
+        with (index_dir / 'meta.json').open() as meta_file:
+            meta = json.load(meta_file)
+        with (index_dir / 'paths.json').open() as paths_file:
+            paths = json.load(paths_file)
+        return cls(DescriptorOptions(**meta['options']), np.load(index_dir / 'vocabulary.npy'),
+                   (np.load(index_dir / 'pca_mean.npy'), np.load(index_dir / 'pca_basis.npy')),
+                   np.load(index_dir / 'vectors.npy', mmap_mode='r'), paths)
+
+    def save(self, index_dir):
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        np.save(index_dir / 'vocabulary.npy', self.vocabulary)
+        np.save(index_dir / 'pca_mean.npy', self.pca[0])
+        np.save(index_dir / 'pca_basis.npy', self.pca[1])
+        np.save(index_dir / 'vectors.npy', self.vectors)
+        with (index_dir / 'paths.json').open('w') as paths_file:
+            json.dump(self.paths, paths_file)
+        with (index_dir / 'meta.json').open('w') as meta_file:
+            json.dump({'options': self.options._asdict()}, meta_file)
+
+    def query(self, des, ncandidates):
+        # Returns the paths of the ncandidates images most similar to the descriptor
+        vector = project_vlad(compute_vlad(des, self.vocabulary, self.options.engine), self.pca)
+        similarities = self.vectors @ vector
+        if ncandidates < len(similarities):
+            top = np.argpartition(similarities, -ncandidates)[-ncandidates:]
+        else:
+            top = np.arange(len(similarities))
+        return [self.paths[i] for i in top[np.argsort(-similarities[top])]]
+
+
+def dhash(img):
+    # Difference hash: whether each pixel is brighter than its right neighbour in a 9x8 thumbnail
+    small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1])
+
+
+def phash(img):
+    # Perceptual hash: whether each low frequency DCT coefficient is above their median
+    small = cv2.resize(img, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].ravel()
+    return np.packbits(low > np.median(low[1:]))
+
+
+# Perceptual hash functions, which return the 64-bit hash as 8 uint8
+HASH_FUNCTIONS = {
+    'phash': phash,
+    'dhash': dhash,
+}
+
+
+def compute_hash(img_path, hash_name):
+    # Returns the hash as a 1x8 uint8 array, so it can be stored in the descriptor cache
+    img = load_image(img_path, DescriptorOptions(HASH_MAX_LENGTH))
+    return HASH_FUNCTIONS[hash_name](img).reshape(1, 8)
+
+
+def hash_to_int(hash_array):
+    return int.from_bytes(hash_array.tobytes(), 'big')
+
+
+class BKTree:
+    # Burkhard-Keller tree of 64-bit hashes under the Hamming distance. Searching for all hashes
+    # within a small distance only visits a fraction of the tree.
+
+    def __init__(self):
+        # Each node is [hash, items, {distance: child node}]
+        self._root = None
+
+    def add(self, hash_value, item):
+        if self._root is None:
+            self._root = [hash_value, [item], dict()]
+            return
+        node = self._root
+        while True:
+            distance = (node[0] ^ hash_value).bit_count()
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash_value, [item], dict()]
+                return
+            node = child
+
+    def search(self, hash_value, max_distance):
+        # Returns (distance, item) of all items within max_distance of hash_value
+        results = list()
+        pending = [self._root] if self._root is not None else []
+        while pending:
+            node = pending.pop()
+            distance = (node[0] ^ hash_value).bit_count()
+            if distance <= max_distance:
+                results.extend((distance, item) for item in node[1])
+            # By the triangle inequality, matches can only be in children within this range
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    pending.append(child)
+        return results
+
+
+class UnionFind:
+    # Disjoint sets of hashable items, for grouping similar images
+
+    def __init__(self):
+        self._parents = dict()
+        # Number of items of each set, by its root
+        self._sizes = dict()
+
+    def find(self, item):
+        root = self._parents.setdefault(item, item)
+        while self._parents[root] != root:
+            root = self._parents[root]
+        # Path compression
+        while item != root:
+            self._parents[item], item = root, self._parents[item]
+        return root
+
+    def union(self, item_a, item_b):
+        # Union by size keeps the trees shallow
+        root_a = self.find(item_a)
+        root_b = self.find(item_b)
+        if root_a == root_b:
+            return
+        size_a = self._sizes.get(root_a, 1)
+        size_b = self._sizes.get(root_b, 1)
+        if size_a > size_b:
+            root_a, root_b = root_b, root_a
+        self._parents[root_a] = root_b
+        self._sizes[root_b] = size_a + size_b
+        self._sizes.pop(root_a, None)
+
+    def groups(self):
+        # Returns all sets with more than one item
+        groups = dict()
+        for item in self._parents:
+            groups.setdefault(self.find(item), list()).append(item)
+        return [group for group in groups.values() if len(group) > 1]
+
+
+class SharedDescriptors:
+    # Descriptors packed into one shared memory block, so they are computed once in the main
+    # process and read by all workers without copying.
+
+    def __init__(self, descriptors):
+        self.layout = list()
+        offset = 0
+        for des in descriptors:
+            offset += -offset % CACHE_ALIGNMENT
+            self.layout.append((offset, des.shape[0], des.shape[1], des.dtype.str))
+            offset += des.nbytes
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for des, (offset, rows, cols, dtype) in zip(descriptors, self.layout):
+            np.ndarray((rows, cols), dtype=dtype, buffer=self.shm.buf, offset=offset)[:] = des
+
+    @property
+    def handle(self):
+        # Picklable arguments for attach()
+        return self.shm.name, self.layout
+
+    @staticmethod
+    def attach(handle):
+        # Returns the shared memory and read-only views of the descriptors in it
+        name, layout = handle
+        # Pool workers share the resource tracker of the main process, which unlinks the shared
+        # memory when the main process exits
+        shm = shared_memory.SharedMemory(name=name)
+        descriptors = list()
+        for offset, rows, cols, dtype in layout:
+            des = np.ndarray((rows, cols), dtype=dtype, buffer=shm.buf, offset=offset)
+            des.flags.writeable = False
+            descriptors.append(des)
+        return shm, descriptors
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class ThreadPool:
+    # Runs worker functions in threads of the main process, with the multiprocessing.Pool
+    # interface used here. The initializer runs once, so the worker globals are shared by all
+    # threads, except for the detectors and matchers, which are created per thread.
+
+    def __init__(self, nthreads, initializer, initargs):
+        self._nthreads = nthreads
+        self._opencv_threads = cv2.getNumThreads()
+        cv2.setNumThreads(opencv_threads(nthreads))
+        initializer(*initargs)
+        self._executor = concurrent.futures.ThreadPoolExecutor(nthreads)
+
+    def imap_unordered(self, func, iterable, chunksize=1):
+        # Only a few items per thread are submitted ahead, so the iterable is consumed lazily
+        pending = set()
+        for item in iterable:
+            if len(pending) >= self._nthreads * chunksize:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(self._executor.submit(func, item))
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+
+    def terminate(self):
+        self._executor.shutdown(cancel_futures=True)
+        reset_worker()
+        cv2.setNumThreads(self._opencv_threads)
+
+    def join(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.terminate()
+
+
+class DurationHistogram:
+    # Count, total, maximum and approximate percentiles of durations, in constant memory
+
+    def __init__(self):
+        nbins = round(math.log10(DURATION_MAX / DURATION_MIN) * DURATION_BINS_PER_DECADE) + 1
+        self.bins = np.zeros(nbins, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        index = int(math.log10(max(duration, DURATION_MIN) / DURATION_MIN) * DURATION_BINS_PER_DECADE)
+        self.bins[min(index, len(self.bins) - 1)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def percentile(self, q):
+        # Returns the middle of the bin of the q-th percentile, which never exceeds the maximum
+        index = np.searchsorted(np.cumsum(self.bins), max(1, math.ceil(q / 100 * self.count)))
+        return min(DURATION_MIN * 10**((index + 0.5) / DURATION_BINS_PER_DECADE), self.max)
+
+
+class Telemetry:
+    # Shows the progress of a pool over the images to scan, and collects histograms of the
+    # durations of the stages of the images for a summary at the end
+
+    def __init__(self, label, args):
+        self.label = label
+        self.stats_jsonl = args.stats_jsonl
+        self.chunksize = args.chunksize
+        self.sampling = FrameSampling(args.frame_interval, args.scene_threshold)
+        self.listed = 0
+        self.listing_done = False
+        # Scanned paths, which may be video segments of many images
+        self.done = 0
+        self.count = 0
+        self.errors = 0
+        self.durations = {stage: DurationHistogram() for stage in STAGES}
+        self._start = time.perf_counter()
+        self._last_update = 0.0
+
+    def _list(self, paths):
+        for path in paths:
+            self.listed += 1
+            yield path
+        self.listing_done = True
+
+    def imap(self, pool, func, paths):
+        # Yields the results of func over paths in the pool, recording their stage durations
+        for results in pool.imap_unordered(functools.partial(run_timed, func, self.sampling),
+                                           self._list(paths),
+                                           chunksize=self.chunksize):
+            self.done += 1
+            for result, times in results:
+                self.count += 1
+                if result is None:
+                    self.errors += 1
+                for stage, duration in times.items():
+                    self.durations[stage].add(duration)
+                yield result
+            now = time.perf_counter()
+            if now - self._last_update >= PROGRESS_INTERVAL:
+                self._last_update = now
+                self.show_progress()
+
+    def show_progress(self):
+        elapsed = time.perf_counter() - self._start
+        if not self.listing_done:
+            # The ETA is unknown until all images are listed
+            total, eta = f'{self.listed}+', '?'
+        else:
+            total = self.listed
+            eta = time.strftime('%H:%M:%S',
+                                time.gmtime((self.listed - self.done) * elapsed / self.done))
+        status_msg(f'{self.label}: {self.done}/{total} paths, {self.count / elapsed:.1f} images/s, '
+                   f'ETA {eta}, {self.errors} errors')
+
+    def summary(self):
+        # Prints the latency percentiles of every stage, and appends them to the JSON Lines file
+        elapsed = time.perf_counter() - self._start
+        info_msg(f'{self.label}: {self.count} images in {elapsed:.2f}s '
+                 f'({self.count / max(elapsed, 1e-9):.1f} images/s), {self.errors} errors',
+                 clear=True,
+                 file=sys.stderr)
+        records = [{
+            'label': self.label,
+            'stage': 'total',
+            'images': self.count,
+            'errors': self.errors,
+            'seconds': elapsed,
+        }]
+        for stage, durations in self.durations.items():
+            if not durations.count:
+                continue
+            p50, p95 = durations.percentile(50) * 1e3, durations.percentile(95) * 1e3
+            slowest = durations.max * 1e3
+            info_msg(f'    {stage:<9} {durations.count:>8} images  p50 {p50:9.2f} ms  '
+                     f'p95 {p95:9.2f} ms  max {slowest:9.2f} ms  total {durations.total:8.2f}s',
+                     file=sys.stderr)
+            records.append({
+                'label': self.label,
+                'stage': stage,
+                'images': durations.count,
+                'p50_ms': p50,
+                'p95_ms': p95,
+                'max_ms': slowest,
+                'seconds': durations.total,
+            })
+        if self.stats_jsonl is not None:
+            with self.stats_jsonl.open('a') as stats_file:
+                for record in records:
+                    stats_file.write(json.dumps(record) + '\n')
+
+
+class Library:
+    # Descriptors of all images under img_root, kept in memory by the query server. Descriptors
+    # are computed by a process pool that lives as long as the library.
+
+    def __init__(self, args, options):
+        self.args = args
+        self.options = options
+        self._lock = threading.Lock()
+        # Maps path to (stat_key, descriptor)
+        self._entries = dict()
+        self._pool = make_pool(args, init_scan_worker, [options, args.cache])
+        self._executor = concurrent.futures.ThreadPoolExecutor(args.threads)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def rescan(self):
+        # Loads descriptors of new and modified images and forgets deleted images.
+        # Returns the number of loaded and forgotten images.
+        current = dict()
+        for img_path in walk_images(self.args.img_root, self.args.scan_threads, self.args.sniff):
+            try:
+                current[img_path] = stat_key(img_path)
+            except OSError:
+                continue
+        with self._lock:
+            known = {img_path: entry[0] for img_path, entry in self._entries.items()}
+        changed = [img_path for img_path, stat in current.items() if known.get(img_path) != stat]
+        loaded = dict()
+        cache = None
+        if self.args.cache is not None:
+            cache = DescriptorCache(self.args.cache, writable=True)
+        try:
+            for result in self._pool.imap_unordered(load_descriptor,
+                                                    changed,
+                                                    chunksize=self.args.chunksize):
+                if result is None:
+                    continue
+                img_path, des, new_key = result
+                if new_key is not None:
+                    cache.add(img_path, *new_key, des)
+                loaded[img_path] = (current[img_path] if new_key is None else new_key[1], des)
+        finally:
+            if cache is not None:
+                cache.close()
+        with self._lock:
+            deleted = self._entries.keys() - current.keys()
+            for img_path in deleted:
+                del self._entries[img_path]
+            self._entries.update(loaded)
+        return len(loaded), len(deleted)
+
+    def search(self, des, ntop):
+        # Returns the ntop (ngood, path) with the most good matches, best first
+        engine = self.options.engine
+        des = matchable(des, engine)
+        index = build_reference_index(des, engine)
+        with self._lock:
+            items = [(img_path, entry[1]) for img_path, entry in self._entries.items()]
+
+        def score_chunk(chunk):
+            # OpenCV releases the GIL while searching, so chunks are scored in parallel
+            results = list()
+            for img_path, scan_des in chunk:
+                try:
+                    results.append((get_good_matches_indexed(index, scan_des, engine), img_path))
+                except _InvalidComputation:
+                    continue
+            return results
+
+        chunks = [items[i:i + SERVE_CHUNK_SIZE] for i in range(0, len(items), SERVE_CHUNK_SIZE)]
+        all_matches = list()
+        for results in self._executor.map(score_chunk, chunks):
+            all_matches.extend(results)
+        all_matches.sort(reverse=True)
+        return all_matches[:ntop]
+
+    def close(self):
+        self._executor.shutdown()
+        self._pool.terminate()
+        self._pool.join()
+
+
+class SearchRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Answers search queries against the Library of the server
+
+    def address_string(self):
+        # UNIX socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _search(self, query, load, params):
+        try:
+            ntop = int(params.get('top', [NTOP])[0])
+            start = time.perf_counter()
+            # Detectors are per thread, so queries are described in parallel
+            _, des = detect_keypoints(load(), self.server.library.options)
+            matches = self.server.library.search(des, ntop)
+        except (_InvalidComputation, OSError, ValueError) as exc:
+            self._send_json(400, {'error': str(exc)})
+            return
+        self._send_json(
+            200, {
+                'query': query,
+                'seconds': time.perf_counter() - start,
+                'results': [{
+                    'path': img_path,
+                    'score': ngood
+                } for ngood, img_path in matches],
+            })
+
+    def do_GET(self): #pylint: disable=invalid-name
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        if url.path == '/status':
+            self._send_json(200, {'images': len(self.server.library)})
+        elif url.path == '/search' and 'path' in params:
+            query_path = params['path'][0]
+            self._search(query_path, lambda: load_image(query_path, self.server.library.options),
+                         params)
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self): #pylint: disable=invalid-name
+        url = urllib.parse.urlsplit(self.path)
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self._send_json(400, {'error': 'Invalid Content-Length'})
+            return
+        if url.path != '/search':
+            self._send_json(404, {'error': 'Not found'})
+        elif not 0 < length <= SERVE_MAX_UPLOAD:
+            self._send_json(413, {'error': 'Invalid Content-Length'})
+        else:
+            data = self.rfile.read(length)
+            self._search('<upload>', lambda: decode_image(data, self.server.library.options),
+                         urllib.parse.parse_qs(url.query))
+
+
+class SearchHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, library):
+        super().__init__(address, SearchRequestHandler)
+        self.library = library
+
+
+class UnixSearchHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, address, library):
+        super().__init__(address, SearchRequestHandler)
+        self.library = library
+
+
 # User interface common functions
 
 
@@ -130,86 +1700,1408 @@ def info_msg(*args, clear=False, **kwargs):
     print(*args, **kwargs)
 
 
-# Process pool worker functions
+# Library scanning functions
 
 
-def init_worker(img_path, max_length):
-    global _REFERENCE_DES, _MAX_LENGTH
-    assert _REFERENCE_DES is None
-    assert _MAX_LENGTH is None
-    _REFERENCE_DES = compute_descriptor(img_path, max_length)
-    _MAX_LENGTH = max_length
+def is_image_header(header):
+    if header.startswith(b'RIFF') and header[8:12] == b'WEBP':
+        return True
+    return header.startswith(IMAGE_MAGIC_BYTES)
 
 
-def compute_ngood(img_path):
-    assert _REFERENCE_DES is not None
-    if not img_path.is_file():
-        error_msg('Skipping non-file', img_path)
+def is_image(path, sniff):
+    if not sniff:
+        return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+    try:
+        with open_image(path) as img_file:
+            header = img_file.read(IMAGE_MAGIC_LENGTH)
+    except (OSError, KeyError, zipfile.BadZipFile, tarfile.TarError):
+        return False
+    return is_image_header(header)
+
+
+def list_archive(archive_path, sniff):
+    # Returns the paths of all images inside an archive. The members are scanned separately, so
+    # a large archive is spread over the whole pool.
+    try:
+        archive = open_archive(archive_path)
+    except (OSError, zipfile.BadZipFile, tarfile.TarError) as exc:
+        error_msg(f'Skipping archive with error "{exc}":', archive_path)
+        return list()
+    img_paths = list()
+    try:
+        for name in archive.namelist():
+            if not sniff:
+                if os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+                    continue
+            elif isinstance(archive, zipfile.ZipFile):
+                if name.endswith('/'):
+                    continue
+                with archive.open(name) as member_file:
+                    if not is_image_header(member_file.read(IMAGE_MAGIC_LENGTH)):
+                        continue
+            elif not is_image_header(archive.read(name, IMAGE_MAGIC_LENGTH)):
+                continue
+            img_paths.append(archive_path + ARCHIVE_SEPARATOR + name)
+    except (OSError, zipfile.BadZipFile) as exc:
+        error_msg(f'Skipping archive with error "{exc}":', archive_path)
+        return list()
+    finally:
+        archive.close()
+    return img_paths
+
+
+def expand_path(path, sniff, segment_seconds=None):
+    # Returns the image paths of a file, which are the images inside it for an archive, and with
+    # segment_seconds, the segments of a video
+    if is_archive(path):
+        return list_archive(path, sniff)
+    if segment_seconds and os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS:
+        return list_video_segments(path, segment_seconds)
+    if is_image(path, sniff):
+        return [path]
+    return list()
+
+
+def _scan_directory(path, sniff, segment_seconds):
+    # Returns the image files and subdirectories of a directory from a single scandir pass.
+    # The dirent type is used, so no files are stat'ed unless the file system lacks it.
+    img_paths = list()
+    subdirs = list()
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    # Symlinks are skipped, since they may form cycles or point outside the root
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        img_paths.extend(expand_path(entry.path, sniff, segment_seconds))
+                except OSError:
+                    continue
+    except OSError as exc:
+        error_msg(f'Skipping directory with error "{exc}":', path)
+    return img_paths, subdirs
+
+
+def walk_images(img_root, nthreads, sniff, segment_seconds=None):
+    # Yields paths of all images under img_root, listing directories in parallel. With
+    # segment_seconds, the segments of videos are yielded too.
+    img_root = str(img_root)
+    if not os.path.isdir(img_root):
+        yield from expand_path(img_root, sniff, segment_seconds)
         return
-    if img_path.is_symlink():
-        error_msg('Skipping symlink', img_path)
+    with concurrent.futures.ThreadPoolExecutor(nthreads) as executor:
+        pending = {executor.submit(_scan_directory, img_root, sniff, segment_seconds)}
+        while pending:
+            done, pending = concurrent.futures.wait(pending,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                img_paths, subdirs = future.result()
+                pending.update(
+                    executor.submit(_scan_directory, subdir, sniff, segment_seconds)
+                    for subdir in subdirs)
+                yield from img_paths
+
+
+def read_stdin_paths(sniff, segment_seconds=None):
+    # Yields image paths from a NUL-separated list on standard input
+    remainder = b''
+    while True:
+        data = sys.stdin.buffer.read1(1 << 16)
+        if not data:
+            break
+        *paths, remainder = (remainder + data).split(b'\0')
+        for path in paths:
+            if path:
+                yield from expand_path(os.fsdecode(path), sniff, segment_seconds)
+    if remainder:
+        yield from expand_path(os.fsdecode(remainder), sniff, segment_seconds)
+
+
+def iter_scan_paths(args):
+    # Yields the paths of the images to scan as strings, which are cheap to send to workers
+    segment_seconds = args.segment_seconds if args.video else None
+    if str(args.img_root) == '-':
+        return read_stdin_paths(args.sniff, segment_seconds)
+    return walk_images(args.img_root, args.scan_threads, args.sniff, segment_seconds)
+
+
+# Process pool worker functions
+
+
+def opencv_threads(nworkers):
+    # Number of OpenCV threads per worker, so the workers do not oversubscribe the CPU threads
+    return max(1, os.cpu_count() // nworkers)
+
+
+def init_pool_worker(nworkers, initializer, initargs):
+    cv2.setNumThreads(opencv_threads(nworkers))
+    initializer(*initargs)
+
+
+def make_pool(args, initializer, initargs):
+    # Returns a process pool, or a thread pool with --executor thread
+    nworkers = args.workers or os.cpu_count()
+    if args.executor == 'thread':
+        return ThreadPool(nworkers, initializer, initargs)
+    return multiprocessing.Pool(nworkers, init_pool_worker, [nworkers, initializer, initargs])
+
+
+def reset_worker():
+    # Undoes the worker initializers, so a thread pool can be initialized again in the same process
+    global _REFERENCE_DESCRIPTORS, _REFERENCE_SHM, _REFERENCE_POINTS, _REFERENCE_INDEXES, _OPTIONS
+    global _CACHE, _VOCABULARY, _PCA, _HASH_NAME
+    _REFERENCE_DESCRIPTORS = _REFERENCE_POINTS = _REFERENCE_INDEXES = None
+    if _REFERENCE_SHM is not None:
+        _REFERENCE_SHM.close()
+    if _CACHE is not None:
+        _CACHE.close()
+    _REFERENCE_SHM = _OPTIONS = _CACHE = _VOCABULARY = _PCA = _HASH_NAME = None
+    _VARIANTS.clear()
+
+
+def init_scan_worker(options, cache_dir):
+    global _OPTIONS, _CACHE
+    assert _OPTIONS is None
+    _OPTIONS = options
+    if cache_dir is not None:
+        _CACHE = DescriptorCache(cache_dir)
+
+
+def init_worker(shared_handle, options, cache_dir, match_mode):
+    global _REFERENCE_DESCRIPTORS, _REFERENCE_INDEXES, _REFERENCE_SHM
+    assert _REFERENCE_DESCRIPTORS is None
+    _REFERENCE_SHM, _REFERENCE_DESCRIPTORS = SharedDescriptors.attach(shared_handle)
+    if match_mode == 'indexed':
+        # The indexes do not copy the descriptors, so the converted ones must be kept
+        _REFERENCE_DESCRIPTORS = [matchable(des, options.engine) for des in _REFERENCE_DESCRIPTORS]
+        _REFERENCE_INDEXES = [
+            build_reference_index(des, options.engine) for des in _REFERENCE_DESCRIPTORS
+        ]
+    init_scan_worker(options, cache_dir)
+
+
+def init_verify_worker(shared_handle, options):
+    # The shared memory contains the descriptors followed by the keypoint coordinates
+    global _REFERENCE_DESCRIPTORS, _REFERENCE_POINTS, _REFERENCE_SHM
+    assert _REFERENCE_DESCRIPTORS is None
+    _REFERENCE_SHM, arrays = SharedDescriptors.attach(shared_handle)
+    _REFERENCE_DESCRIPTORS = arrays[:len(arrays) // 2]
+    _REFERENCE_POINTS = arrays[len(arrays) // 2:]
+    init_scan_worker(options, None)
+
+
+def init_compact_bench_worker(query_paths, variants):
+    # Computes the query descriptors of every variant. The first variant must not be compact.
+    global _REFERENCE_DESCRIPTORS
+    base_options = variants[0]
+    raw_descriptors = [compute_descriptor(path, base_options) for path in query_paths]
+    _REFERENCE_DESCRIPTORS = [[compact_descriptor(des, options)
+                               for des in raw_descriptors]
+                              for options in variants]
+    _VARIANTS.extend(variants)
+    init_scan_worker(base_options, None)
+
+
+def init_hash_worker(cache_dir, hash_name):
+    global _HASH_NAME
+    _HASH_NAME = hash_name
+    init_scan_worker(DescriptorOptions(HASH_MAX_LENGTH), cache_dir)
+
+
+def init_index_worker(options, cache_dir, vocabulary, pca):
+    global _VOCABULARY, _PCA
+    _VOCABULARY = vocabulary
+    _PCA = pca
+    init_scan_worker(options, cache_dir)
+
+
+def run_timed(func, sampling, scan_path):
+    # Runs a worker function on an image, or on every sampled frame of a video segment. Returns a
+    # list of its results with the durations of the stages by name.
+    segment = split_video_path(scan_path)
+    if segment is None or segment[2] is None:
+        _STAGE_TIMES.times = dict()
+        try:
+            result = func(scan_path)
+        finally:
+            times = _STAGE_TIMES.times
+            _STAGE_TIMES.times = None
+        return [(result, times)]
+
+    # Only the frame being processed is kept in memory, for load_image to return
+    results = list()
+    frames = sample_frames(*segment, sampling)
+    try:
+        while True:
+            _STAGE_TIMES.times = dict()
+            try:
+                with timed('decode'):
+                    timestamp, img = next(frames)
+            except StopIteration:
+                break
+            except BaseException as exc:
+                error_msg(f'Skipping video segment with error "{exc}":', scan_path)
+                results.append((None, _STAGE_TIMES.times))
+                break
+            _CURRENT_FRAME.path = f'{segment[0]}{VIDEO_FRAGMENT}{timestamp:.3f}'
+            _CURRENT_FRAME.img = img
+            results.append((func(_CURRENT_FRAME.path), _STAGE_TIMES.times))
+    finally:
+        frames.close()
+        _STAGE_TIMES.times = None
+        _CURRENT_FRAME.path = _CURRENT_FRAME.img = None
+    return results
+
+
+def get_cached(img_path, variant, compute):
+    # Returns compute(img_path) and, if it was not cached, the cache entry to store in the main
+    # process
+    if _CACHE is None:
+        return compute(img_path), None
+    stat = stat_key(img_path)
+    value = _CACHE.lookup(img_path, variant, stat)
+    if value is not None:
+        return value, None
+    value = compute(img_path)
+    return value, (variant, stat, value)
+
+
+def get_descriptor(img_path):
+    return get_cached(img_path, _OPTIONS.variant, lambda path: compute_descriptor(path, _OPTIONS))
+
+
+def get_hash(img_path):
+    # Returns the hash of an image, or None on error
+    try:
+        hash_array, new_entry = get_cached(img_path, _HASH_NAME,
+                                           lambda path: compute_hash(path, _HASH_NAME))
+    except BaseException as exc:
+        error_msg(f'Skipping img with error "{exc}":', img_path)
         return
+    return img_path, hash_to_int(hash_array), new_entry
 
+
+def compute_ngood(img_path):
+    assert _REFERENCE_DESCRIPTORS is not None
     try:
-        status_msg('Processing', img_path)
         try:
-            scan_des = compute_descriptor(img_path, _MAX_LENGTH)
+            scan_des, new_entry = get_descriptor(img_path)
         except _InvalidComputation as exc:
             error_msg(f'Skipping img with compute_descriptor error "{str(exc)}":', img_path)
             return
         try:
-            ngood = get_good_matches(_REFERENCE_DES, scan_des)
+            ngoods = score_descriptor(scan_des)
         except _InvalidComputation as exc:
             error_msg(f'Skipping img with get_good_matches error "{str(exc)}":', img_path)
             return
     except BaseException as exc:
         error_msg(f'Threw exception on {img_path}: {exc}')
         return
-    return ngood, img_path
+    return ngoods, img_path, new_entry
+
+
+def cache_descriptor(img_path):
+    # Makes sure the descriptor of an image is cached. Returns the new cache entry, if any, or
+    # None on error.
+    try:
+        _, new_entry = get_descriptor(img_path)
+    except BaseException as exc:
+        error_msg(f'Skipping img with error "{exc}":', img_path)
+        return
+    return img_path, new_entry
+
+
+def load_descriptor(img_path):
+    # Returns the descriptor of an image for keeping it in the main process, and if it was not
+    # cached, the variant and stat_key to cache it with. Returns None on error.
+    try:
+        des, new_entry = get_descriptor(img_path)
+    except BaseException as exc:
+        error_msg(f'Skipping img with error "{exc}":', img_path)
+        return
+    return img_path, np.array(des), None if new_entry is None else new_entry[:2]
+
+
+def compute_inliers(img_path):
+    # Returns the RANSAC inlier counts against every query image, or None on error
+    assert _REFERENCE_POINTS is not None
+    try:
+        # Keypoint coordinates are not cached, so this is only used on a few candidates
+        scan_points, scan_des = compute_keypoints(img_path, _OPTIONS)
+        ninliers = list()
+        with timed('match'):
+            for ref_des, ref_points in zip(_REFERENCE_DESCRIPTORS, _REFERENCE_POINTS):
+                pairs = good_match_pairs(ref_des, scan_des, _OPTIONS.engine)
+                ninliers.append(count_inliers(ref_points, scan_points, pairs))
+    except BaseException as exc:
+        error_msg(f'Skipping img with error "{exc}":', img_path)
+        return
+    return ninliers, img_path, None
+
+
+def compare_compact(img_path):
+    # Scores an image with every descriptor variant. Returns the path and, per variant, the
+    # good match counts, descriptor size in bytes and match time. Returns None on error.
+    try:
+        raw_des = compute_descriptor(img_path, _OPTIONS)
+        results = list()
+        for options, ref_descriptors in zip(_VARIANTS, _REFERENCE_DESCRIPTORS):
+            des = compact_descriptor(raw_des, options)
+            start = time.perf_counter()
+            ngoods = [
+                get_good_matches(ref_des, des, options.engine) for ref_des in ref_descriptors
+            ]
+            results.append((ngoods, des.nbytes, time.perf_counter() - start))
+    except BaseException as exc:
+        error_msg(f'Threw exception on {img_path}: {exc}')
+        return
+    return img_path, results
+
+
+def compare_match_modes(img_path):
+    # Scores an image with both match modes. Returns None on error, like compute_ngood
+    assert _REFERENCE_INDEXES is not None
+    try:
+        scan_des, new_entry = get_descriptor(img_path)
+        start = time.perf_counter()
+        ngood_pairwise = [
+            get_good_matches(des, scan_des, _OPTIONS.engine) for des in _REFERENCE_DESCRIPTORS
+        ]
+        pairwise_time = time.perf_counter() - start
+        start = time.perf_counter()
+        ngood_indexed = [
+            get_good_matches_indexed(index, scan_des, _OPTIONS.engine)
+            for index in _REFERENCE_INDEXES
+        ]
+        indexed_time = time.perf_counter() - start
+    except BaseException as exc:
+        error_msg(f'Threw exception on {img_path}: {exc}')
+        return
+    return img_path, new_entry, (ngood_pairwise, pairwise_time), (ngood_indexed, indexed_time)
+
+
+def compute_global_vector(img_path):
+    # Returns the (PCA-reduced, if available) VLAD vector of an image, or None on error
+    assert _VOCABULARY is not None
+    try:
+        des, new_entry = get_descriptor(img_path)
+        vector = compute_vlad(des, _VOCABULARY, _OPTIONS.engine)
+        if _PCA is not None:
+            vector = project_vlad(vector, _PCA)
+    except BaseException as exc:
+        error_msg(f'Skipping img with error "{exc}":', img_path)
+        return
+    return img_path, vector.astype(np.float32), new_entry
+
+
+def sample_descriptor(img_path):
+    # Returns a random subset of an image's descriptors for vocabulary training, or None on error
+    try:
+        des, new_entry = get_descriptor(img_path)
+    except BaseException as exc:
+        error_msg(f'Skipping img with error "{exc}":', img_path)
+        return
+    nsample = max(1, VLAD_TRAIN_DESCRIPTORS // VLAD_TRAIN_IMAGES)
+    if des.shape[0] > nsample:
+        des = des[np.random.default_rng().choice(des.shape[0], nsample, replace=False)]
+    return img_path, np.array(des), new_entry
 
 
 # Main process functions
 
 
+def collect_query_paths(paths, sniff):
+    # Expands directories into the images they contain, skipping their other files like the
+    # library walk does
+    query_paths = list()
+    for path in paths:
+        if path.is_dir():
+            img_paths = list()
+            for child in path.iterdir():
+                if child.is_file():
+                    img_paths.extend(map(Path, expand_path(str(child), sniff)))
+            query_paths.extend(sorted(img_paths))
+        elif is_archive(str(path)):
+            query_paths.extend(map(Path, list_archive(str(path), sniff=False)))
+        else:
+            query_paths.append(path)
+    return query_paths
+
+
+def select_candidates(index_dir, query_paths, img_root, ncandidates):
+    # Returns the union of the index candidates of all query images under img_root
+    index = GlobalIndex.load(index_dir)
+    prefix = '' if str(img_root) == '-' else os.path.abspath(img_root).rstrip(os.sep) + os.sep
+    candidates = set()
+    for query_path in query_paths:
+        des = compute_descriptor(query_path, index.options)
+        candidates.update(path for path in index.query(des, ncandidates) if path.startswith(prefix))
+    return sorted(candidates)
+
+
+def compute_query_descriptors(query_paths, options, with_points=False):
+    # Computes the query descriptors once in the main process and shares them with the workers.
+    # With with_points, the keypoint coordinates of all queries follow the descriptors.
+    descriptors = list()
+    all_points = list()
+    for query_path in query_paths:
+        try:
+            points, des = compute_keypoints(query_path, options)
+        except _InvalidComputation as exc:
+            error_msg(f'Cannot use query image with error "{exc}":', query_path)
+            sys.exit(1)
+        descriptors.append(des)
+        all_points.append(points)
+    if with_points:
+        return SharedDescriptors(descriptors + all_points)
+    return SharedDescriptors(descriptors)
+
+
+def compute_library_hashes(args):
+    # Returns a BK-tree of the hashes of all images, and a dict of their hashes by path
+    cache = None
+    if args.cache is not None:
+        cache = DescriptorCache(args.cache, writable=True)
+    tree = BKTree()
+    hashes = dict()
+    status_msg('Initializing workers...')
+    try:
+        telemetry = Telemetry('Hashing', args)
+        with make_pool(args, init_hash_worker, [args.cache, args.hash]) as pool:
+            for result in telemetry.imap(pool, get_hash, iter_scan_paths(args)):
+                if result is None:
+                    continue
+                img_path, hash_value, new_entry = result
+                tree.add(hash_value, img_path)
+                hashes[img_path] = hash_value
+                if new_entry is not None:
+                    cache.add(img_path, *new_entry)
+    finally:
+        if cache is not None:
+            cache.close()
+    telemetry.summary()
+    return tree, hashes
+
+
+def search_hash(args):
+    query_hashes = list()
+    for query_path in collect_query_paths(args.query_imgs, args.sniff):
+        try:
+            query_hashes.append((query_path, hash_to_int(compute_hash(query_path, args.hash))))
+        except _InvalidComputation as exc:
+            error_msg(f'Cannot use query image with error "{exc}":', query_path)
+            sys.exit(1)
+    tree, _ = compute_library_hashes(args)
+    info_msg(end='', clear=True)
+    for query_path, query_hash in query_hashes:
+        info_msg(f'Images within distance {args.max_distance} of {query_path}:')
+        for distance, scan_path in sorted(tree.search(query_hash, args.max_distance),
+                                          reverse=True):
+            info_msg(scan_path, f'({distance})')
+
+
+def shard_ranges(descriptors, max_rows):
+    # Splits the descriptors into consecutive ranges with at most max_rows rows in total, unless a
+    # single descriptor has more
+    start = 0
+    rows = 0
+    for end, des in enumerate(descriptors):
+        if rows and rows + des.shape[0] > max_rows:
+            yield start, end
+            start = end
+            rows = 0
+        rows += des.shape[0]
+    if start < len(descriptors):
+        yield start, len(descriptors)
+
+
+def group_similar(descriptors, engine, min_good, max_shard_rows, executor):
+    # Yields pairs of indices into descriptors of images with at least min_good good matches.
+    # Each shard of images gets a FLANN index of all their descriptors, labelled by image, and the
+    # descriptors of every image are matched against it, so memory is bounded by the shard size.
+    for shard_number, (start, end) in enumerate(shard_ranges(descriptors, max_shard_rows), 1):
+        status_msg(f'Building index of shard {shard_number} (images {start} to {end})...')
+        shard_descriptors = [matchable(des, engine) for des in descriptors[start:end]]
+        labels = np.repeat(np.arange(start, end), [des.shape[0] for des in shard_descriptors])
+        shard_des = np.concatenate(shard_descriptors)
+        index = cv2.flann_Index(shard_des, ENGINES[engine].index_params)
+        knn = min(GROUP_KNN_MATCHES, shard_des.shape[0])
+
+        def vote(image):
+            # Images with at least min_good descriptors among the nearest neighbours are candidates,
+            # and are then matched pairwise, so the ratio test compares the two nearest descriptors
+            # of the same image. Comparing neighbours from different images would reject every
+            # match when an image has several equally close copies.
+            indices, _ = index.knnSearch(matchable(descriptors[image], engine), knn,
+                                         params=flann_search_params)
+            # LSH indexes return -1 for missing neighbours
+            rows, columns = np.nonzero(indices >= 0)
+            # Each descriptor counts at most once per image
+            pairs = np.unique(rows * len(descriptors) + labels[indices[rows, columns]])
+            votes = np.bincount(pairs % len(descriptors) - start, minlength=end - start)
+            if start <= image < end:
+                votes[image - start] = 0
+            similar = list()
+            for other in np.flatnonzero(votes >= min_good) + start:
+                try:
+                    ngood = get_good_matches(descriptors[image], descriptors[other], engine)
+                except _InvalidComputation:
+                    continue
+                if ngood >= min_good:
+                    similar.append(other)
+            return similar
+
+        for image, similar in enumerate(executor.map(vote, range(len(descriptors)))):
+            status_msg(f'Matching shard {shard_number}: {image + 1}/{len(descriptors)}')
+            for other in similar:
+                yield image, int(other)
+
+
+def dupes_sift(args):
+    if args.cache is None:
+        error_msg('dupes --mode sift needs --cache to keep descriptors on disk instead of memory')
+        sys.exit(1)
+    options = descriptor_options(args)
+    cache = DescriptorCache(args.cache, writable=True)
+    img_paths = list()
+    status_msg('Initializing workers...')
+    try:
+        telemetry = Telemetry('Describing', args)
+        with make_pool(args, init_scan_worker, [options, args.cache]) as pool:
+            for result in telemetry.imap(pool, cache_descriptor, iter_scan_paths(args)):
+                if result is None:
+                    continue
+                img_path, new_entry = result
+                img_paths.append(img_path)
+                if new_entry is not None:
+                    cache.add(img_path, *new_entry)
+    finally:
+        cache.close()
+    telemetry.summary()
+
+    # Reopen the cache to map all descriptors, which are then paged in as needed
+    cache = DescriptorCache(args.cache)
+    paths = list()
+    descriptors = list()
+    for img_path in sorted(img_paths):
+        try:
+            des = cache.lookup(img_path, options.variant, stat_key(img_path))
+        except OSError:
+            des = None
+        if des is not None and des.shape[0] >= FLANN_KNN_MATCHES:
+            paths.append(img_path)
+            descriptors.append(des)
+    groups = UnionFind()
+    with concurrent.futures.ThreadPoolExecutor(args.threads) as executor:
+        for image, other in group_similar(descriptors, options.engine, args.min_good,
+                                          args.shard_descriptors, executor):
+            groups.union(paths[image], paths[other])
+    print_groups(groups)
+
+
+def print_groups(groups):
+    info_msg(end='', clear=True)
+    for number, group in enumerate(sorted(map(sorted, groups.groups())), start=1):
+        info_msg(f'Group {number} ({len(group)} images):')
+        for img_path in group:
+            info_msg(f'    {img_path}')
+
+
+def dupes(args):
+    if args.mode == 'sift':
+        dupes_sift(args)
+        return
+    tree, hashes = compute_library_hashes(args)
+    status_msg('Grouping duplicates...')
+    groups = UnionFind()
+    for img_path, hash_value in hashes.items():
+        for _, other_path in tree.search(hash_value, args.max_distance):
+            if other_path != img_path:
+                groups.union(img_path, other_path)
+    print_groups(groups)
+
+
+def descriptor_options(args):
+    if not ENGINES[args.engine].squared_distances and (args.rootsift or args.pca):
+        error_msg('--rootsift and --pca only apply to the sift engine')
+        sys.exit(1)
+    if args.quantize and not args.pca:
+        error_msg('--quantize requires --pca')
+        sys.exit(1)
+    pca = ''
+    pca_digest = ''
+    if args.pca:
+        pca = os.path.abspath(args.pca)
+        pca_digest = file_digest(pca)
+        if bool(load_pca_basis(pca)['rootsift']) != args.rootsift:
+            error_msg('--rootsift must match the setting the PCA basis was trained with')
+            sys.exit(1)
+    return DescriptorOptions(args.resize, args.full_decode, args.engine, 0, args.rootsift, pca,
+                             pca_digest, args.quantize)
+
+
+def run_search_pass(args, options, query_paths, scan_paths, label, verify=False):
+    # Scores all scan_paths against the query images. Returns a list of (score, path) per query.
+    # With verify, the score is the number of RANSAC inliers instead of good matches.
+    cache = None
+    if args.cache is not None and not verify:
+        # Open before the workers so they can see the cache directory
+        cache = DescriptorCache(args.cache, writable=True)
+
+    status_msg('Computing query descriptors...')
+    shared_queries = compute_query_descriptors(query_paths, options, with_points=verify)
+    status_msg('Initializing workers...')
+    if verify:
+        initializer, initargs, func = init_verify_worker, [shared_queries.handle,
+                                                           options], compute_inliers
+    else:
+        initializer, initargs, func = init_worker, [
+            shared_queries.handle, options, args.cache, args.match_mode
+        ], compute_ngood
+    all_matches = [list() for _ in query_paths]
+    telemetry = Telemetry(label, args)
+    try:
+        with make_pool(args, initializer, initargs) as pool:
+            # Since func only returns None (on error) or a tuple (on success), skip all None
+            for result in telemetry.imap(pool, func, scan_paths):
+                if result is None:
+                    continue
+                ngoods, scan_path, new_entry = result
+                for query_matches, ngood in zip(all_matches, ngoods):
+                    query_matches.append((ngood, scan_path))
+                if new_entry is not None:
+                    cache.add(scan_path, *new_entry)
+    finally:
+        shared_queries.close()
+        if cache is not None:
+            cache.close()
+    telemetry.summary()
+    return all_matches
+
+
+def best_video_frames(query_matches):
+    # Keeps only the best scored frame of every video in a list of (score, path)
+    best = dict()
+    for score, scan_path in query_matches:
+        video_frame = split_video_path(scan_path)
+        source = scan_path if video_frame is None else video_frame[0]
+        if source not in best or score > best[source][0]:
+            best[source] = (score, scan_path)
+    return list(best.values())
+
+
+def top_paths(all_matches, ntop):
+    # Returns the union of the top ntop paths of every query
+    paths = set()
+    for query_matches in all_matches:
+        paths.update(scan_path for _, scan_path in sorted(query_matches)[-ntop:])
+    return sorted(paths)
+
+
+def search(args):
+    if args.mode == 'phash':
+        search_hash(args)
+        return
+    options = descriptor_options(args)
+    query_paths = collect_query_paths(args.query_imgs, args.sniff)
+    if args.index is None:
+        scan_paths = iter_scan_paths(args)
+    else:
+        status_msg('Selecting candidates from index...')
+        scan_paths = select_candidates(args.index, query_paths, args.img_root, args.candidates)
+    if args.cascade:
+        coarse_options = options._replace(max_length=args.coarse_resize,
+                                          nfeatures=args.coarse_features)
+        all_matches = run_search_pass(args, coarse_options, query_paths, scan_paths, 'Coarse')
+        scan_paths = top_paths(all_matches, args.refine)
+    all_matches = run_search_pass(args, options, query_paths, scan_paths, 'Matching')
+    score_name = ''
+    if args.ransac:
+        scan_paths = top_paths(all_matches, NTOP)
+        all_matches = run_search_pass(args, options, query_paths, scan_paths, 'Verifying',
+                                      verify=True)
+        score_name = ' inliers'
+    info_msg(end='', clear=True)
+    for query_path, query_matches in zip(query_paths, all_matches):
+        query_matches = best_video_frames(query_matches)
+        query_matches.sort()
+        info_msg(f'Top {NTOP} matches for {query_path}:')
+        for ngood, scan_path in query_matches[-NTOP:]:
+            info_msg(scan_path, f'({ngood}{score_name})')
+
+
+def bench_match_modes(args):
+    options = descriptor_options(args)
+    query_paths = collect_query_paths(args.query_imgs, args.sniff)
+    cache = None
+    if args.cache is not None:
+        cache = DescriptorCache(args.cache, writable=True)
+
+    status_msg('Computing query descriptors...')
+    shared_queries = compute_query_descriptors(query_paths, options)
+    status_msg('Initializing workers...')
+    # Maps each mode to a {path: ngood} dict per query image
+    scores = {mode: [dict() for _ in query_paths] for mode in MATCH_MODES}
+    times = {mode: 0.0 for mode in MATCH_MODES}
+    try:
+        with make_pool(args, init_worker,
+                       [shared_queries.handle, options, args.cache, 'indexed']) as pool:
+            for result in pool.imap_unordered(compare_match_modes,
+                                              iter_scan_paths(args),
+                                              chunksize=args.chunksize):
+                if result is None:
+                    continue
+                scan_path, new_entry, *mode_results = result
+                for mode, (ngoods, match_time) in zip(MATCH_MODES, mode_results):
+                    for query_scores, ngood in zip(scores[mode], ngoods):
+                        query_scores[scan_path] = ngood
+                    times[mode] += match_time
+                if new_entry is not None:
+                    cache.add(scan_path, *new_entry)
+    finally:
+        shared_queries.close()
+        if cache is not None:
+            cache.close()
+    info_msg(f'Compared {len(scores["pairwise"][0])} images with {len(query_paths)} queries',
+             clear=True)
+    for mode in MATCH_MODES:
+        info_msg(f'{mode}: {times[mode]:.3f}s total match time')
+    # Averaged over all query images
+    for ntop in (10, NTOP):
+        agreements = np.array([
+            ranking_agreement(pairwise_scores, indexed_scores, ntop)
+            for pairwise_scores, indexed_scores in zip(scores['pairwise'], scores['indexed'])
+        ])
+        info_msg(f'Top {ntop} overlap: {agreements[:, 0].mean():.1%}')
+    info_msg(f'Spearman rank correlation: {agreements[:, 1].mean():.4f}')
+
+
+def process_tree_pss(pid):
+    # Returns the summed proportional set size in bytes of a process and all its descendants, so
+    # memory shared between forked workers is only counted once. Linux only.
+    children = dict()
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            continue
+        # The process name in parentheses may contain spaces
+        ppid = int(stat.rpartition(')')[2].split()[1])
+        children.setdefault(ppid, list()).append(int(entry))
+    total = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        pids.extend(children.get(current, ()))
+        try:
+            with open(f'/proc/{current}/smaps_rollup') as smaps_file:
+                for line in smaps_file:
+                    if line.startswith('Pss:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+def bench_executor(args):
+    # Runs the same search with every executor in a subprocess, and measures the throughput and
+    # peak memory of each
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        error_msg('bench executor needs /proc/PID/smaps_rollup to measure memory')
+        sys.exit(1)
+    status_msg('Listing images...')
+    scan_paths = list(iter_scan_paths(args))
+    command = [
+        sys.executable,
+        os.path.abspath(__file__), 'search', '--chunksize',
+        str(args.chunksize), '--resize',
+        str(args.resize), '--engine', args.engine, '--match-mode', args.match_mode
+    ]
+    if args.workers:
+        command += ['--workers', str(args.workers)]
+    if args.full_decode:
+        command.append('--full-decode')
+    if args.rootsift:
+        command.append('--rootsift')
+    if args.pca:
+        command += ['--pca', str(args.pca)]
+    if args.quantize:
+        command.append('--quantize')
+    with tempfile.TemporaryFile() as paths_file:
+        # The scan paths are passed on standard input, so both executors scan the same images
+        paths_file.write(b''.join(os.fsencode(path) + b'\0' for path in scan_paths))
+        for executor in EXECUTORS:
+            status_msg(f'Searching with the {executor} executor...')
+            paths_file.seek(0)
+            start = time.perf_counter()
+            process = subprocess.Popen(command + ['--executor', executor] +
+                                       [str(path) for path in args.query_imgs] + ['-'],
+                                       stdin=paths_file,
+                                       stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.DEVNULL)
+            peak_pss = 0
+            while True:
+                # os.wait4 instead of Popen.poll, for the resource usage of the finished process
+                pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+                if pid:
+                    break
+                peak_pss = max(peak_pss, process_tree_pss(process.pid))
+                time.sleep(BENCH_MEMORY_INTERVAL)
+            elapsed = time.perf_counter() - start
+            process.returncode = os.waitstatus_to_exitcode(status)
+            if process.returncode:
+                error_msg(f'{executor}: search failed with exit code {process.returncode}')
+                continue
+            # ru_maxrss is in KiB on Linux
+            info_msg(f'{executor}: {elapsed:.2f}s, {len(scan_paths) / elapsed:.1f} images/s, '
+                     f'peak PSS {peak_pss / 2**20:.1f} MiB, '
+                     f'largest process RSS {rusage.ru_maxrss / 2**10:.1f} MiB',
+                     clear=True)
+
+
+def serve(args):
+    if str(args.img_root) == '-':
+        error_msg('serve needs an img_root directory to rescan')
+        sys.exit(1)
+    options = descriptor_options(args)
+    library = Library(args, options)
+    try:
+        status_msg('Loading library...')
+        loaded, _ = library.rescan()
+        info_msg(f'Loaded {loaded} images', clear=True)
+        if args.unix is not None:
+            if args.unix.exists():
+                args.unix.unlink()
+            server = UnixSearchHTTPServer(str(args.unix), library)
+            info_msg(f'Serving on {args.unix}')
+        else:
+            host, _, port = args.listen.rpartition(':')
+            server = SearchHTTPServer((host, int(port)), library)
+            info_msg(f'Serving on {args.listen}')
+
+        def rescan_loop():
+            while True:
+                time.sleep(args.rescan_interval)
+                loaded, deleted = library.rescan()
+                if loaded or deleted:
+                    info_msg(f'Rescan loaded {loaded} and forgot {deleted} images')
+
+        if args.rescan_interval > 0:
+            threading.Thread(target=rescan_loop, daemon=True).start()
+        with server:
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        library.close()
+
+
+def bench_compact(args):
+    base_options = descriptor_options(args)._replace(rootsift=False,
+                                                     pca='',
+                                                     pca_digest='',
+                                                     quantize=False)
+    variants = {
+        'float32': base_options,
+        'rootsift': base_options._replace(rootsift=True),
+    }
+    if args.pca:
+        pca_options = descriptor_options(args)._replace(quantize=False)
+        basis = load_pca_basis(pca_options.pca)
+        dims = basis['basis'].shape[1]
+        variants[f'pca{dims}'] = pca_options
+        variants[f'pca{dims}-uint8'] = pca_options._replace(quantize=True)
+    query_paths = collect_query_paths(args.query_imgs, args.sniff)
+
+    status_msg('Initializing workers...')
+    # Maps each variant to a {path: ngood} dict per query image
+    scores = {name: [dict() for _ in query_paths] for name in variants}
+    nbytes = {name: 0 for name in variants}
+    times = {name: 0.0 for name in variants}
+    count = 0
+    with make_pool(args, init_compact_bench_worker,
+                   [query_paths, list(variants.values())]) as pool:
+        for result in pool.imap_unordered(compare_compact,
+                                          iter_scan_paths(args),
+                                          chunksize=args.chunksize):
+            if result is None:
+                continue
+            scan_path, variant_results = result
+            count += 1
+            for name, (ngoods, variant_nbytes, match_time) in zip(variants, variant_results):
+                for query_scores, ngood in zip(scores[name], ngoods):
+                    query_scores[scan_path] = ngood
+                nbytes[name] += variant_nbytes
+                times[name] += match_time
+    if not count:
+        error_msg('No images were compared')
+        return
+    info_msg(f'Compared {count} images with {len(query_paths)} queries', clear=True)
+    for name in variants:
+        # Averaged over all query images
+        agreements = np.array([
+            ranking_agreement(base_scores, variant_scores, NTOP)
+            for base_scores, variant_scores in zip(scores['float32'], scores[name])
+        ])
+        info_msg(f'{name}: {nbytes[name] / count / 1024:.1f} KiB/image, '
+                 f'{times[name] / count * 1e3:.2f} ms/image match time, '
+                 f'top {NTOP} overlap {agreements[:, 0].mean():.1%}, '
+                 f'Spearman {agreements[:, 1].mean():.4f}')
+
+
+def pca_train(args):
+    options = descriptor_options(args)._replace(pca='', pca_digest='', quantize=False)
+    img_paths = list(iter_scan_paths(args))
+    train_paths = random.sample(img_paths, min(len(img_paths), VLAD_TRAIN_IMAGES))
+    samples = list()
+    status_msg('Initializing workers...')
+    with make_pool(args, init_index_worker, [options, None, None, None]) as pool:
+        for count, result in enumerate(
+                pool.imap_unordered(sample_descriptor, train_paths, chunksize=args.chunksize)):
+            status_msg(f'Sampling descriptors: {count + 1}/{len(train_paths)}')
+            if result is not None:
+                samples.append(result[1])
+    samples = np.concatenate(samples).astype(np.float32)
+    status_msg('Training PCA...')
+    mean = samples.mean(axis=0)
+    _, _, vt = np.linalg.svd(samples - mean, full_matrices=False)
+    basis = vt[:args.dims].T
+    projected = (samples - mean) @ basis
+    low, high = np.percentile(projected, QUANTIZE_PERCENTILES, axis=0)
+    # Through a file object, np.savez writes the path as given instead of appending .npz
+    with args.basis_file.open('wb') as basis_file:
+        np.savez(basis_file,
+                 mean=mean.astype(np.float32),
+                 basis=basis.astype(np.float32),
+                 quantize_low=low.astype(np.float32),
+                 quantize_scale=np.float32(255 / (high - low).max()),
+                 rootsift=args.rootsift)
+    info_msg(f'Trained {basis.shape[1]}-dimensional PCA basis on {len(samples)} descriptors',
+             clear=True)
+
+
+def bench_decode(args):
+    # Compares full and reduced decoding of JPEG images, including the final downscale
+    full_options = DescriptorOptions(args.resize, full_decode=True)
+    reduced_options = DescriptorOptions(args.resize)
+    megapixels = 0.0
+    times = {'full': 0.0, 'reduced': 0.0}
+    count = 0
+    for img_path in iter_scan_paths(args):
+        if count >= args.limit:
+            break
+        with open_image(img_path) as img_file:
+            dimensions = jpeg_dimensions(img_file)
+        if dimensions is None:
+            continue
+        try:
+            for name, options in (('full', full_options), ('reduced', reduced_options)):
+                start = time.perf_counter()
+                load_image(img_path, options)
+                times[name] += time.perf_counter() - start
+        except _InvalidComputation as exc:
+            error_msg(f'Skipping img with error "{exc}":', img_path)
+            continue
+        megapixels += dimensions[0] * dimensions[1] / 1e6
+        count += 1
+        status_msg(f'Decoded {count} JPEG images')
+    if not count:
+        error_msg('No JPEG images found')
+        return
+    info_msg(f'Decoded {count} JPEG images ({megapixels:.1f} MP) to {args.resize} px', clear=True)
+    for name, total in times.items():
+        info_msg(f'{name}: {total / count * 1e3:.2f} ms/image, {total / megapixels * 1e3:.2f} ms/MP')
+
+
+def index_build(args):
+    options = descriptor_options(args)
+    img_paths = list(iter_scan_paths(args))
+    train_paths = random.sample(img_paths, min(len(img_paths), VLAD_TRAIN_IMAGES))
+    cache = None
+    if args.cache is not None:
+        cache = DescriptorCache(args.cache, writable=True)
+
+    def run_pass(message, initargs, func, paths):
+        # Yields the results of func over paths, and stores new descriptors in the cache
+        telemetry = Telemetry(message, args)
+        with make_pool(args, init_index_worker, initargs) as pool:
+            for result in telemetry.imap(pool, func, paths):
+                if result is None:
+                    continue
+                img_path, value, new_entry = result
+                if new_entry is not None:
+                    cache.add(img_path, *new_entry)
+                yield img_path, value
+        telemetry.summary()
+
+    try:
+        samples = [
+            des for _, des in run_pass('Sampling descriptors', [
+                options, args.cache, None, None
+            ], sample_descriptor, train_paths)
+        ]
+        if cache is not None:
+            # Let the following passes read the descriptors computed so far
+            cache.save()
+        status_msg('Training vocabulary...')
+        vocabulary = train_vocabulary(np.concatenate(samples), args.vocabulary_size, options.engine)
+        train_vlads = np.array([
+            vlad for _, vlad in run_pass('Training PCA', [options, args.cache, vocabulary, None],
+                                         compute_global_vector, train_paths)
+        ])
+        pca = train_pca(train_vlads, args.pca_dims)
+        if cache is not None:
+            cache.save()
+        paths = list()
+        vectors = list()
+        for img_path, vector in run_pass('Indexing', [options, args.cache, vocabulary, pca],
+                                         compute_global_vector, img_paths):
+            paths.append(os.path.abspath(img_path))
+            vectors.append(vector)
+    finally:
+        if cache is not None:
+            cache.close()
+    GlobalIndex(options, vocabulary, pca, np.array(vectors, dtype=np.float32),
+                paths).save(args.index_dir)
+    info_msg(f'Indexed {len(paths)} images into {args.index_dir}', clear=True)
+
+
+def cache_compact(args):
+    cache = DescriptorCache(args.cache_dir, writable=True)
+    try:
+        removed = cache.compact()
+    finally:
+        cache.close()
+    info_msg(f'Removed {removed} stale entries, kept {len(cache)}')
+
+
+def cache_invalidate(args):
+    cache = DescriptorCache(args.cache_dir, writable=True)
+    try:
+        removed = cache.invalidate(args.paths)
+    finally:
+        cache.close()
+    info_msg(f'Invalidated {removed} entries. Run "cache compact" to reclaim space.')
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument(
+    subparsers = parser.add_subparsers(required=True)
+
+    # Options common to all commands that compute descriptors in a process pool
+    pool_parser = argparse.ArgumentParser(add_help=False)
+    pool_parser.add_argument(
         '--workers',
         type=int,
         help=
-        f'Number of worker subprocesses to launch. If not specified, defaults to the number of CPU threads (found: {os.cpu_count()}).'
+        f'Number of worker subprocesses or threads to launch. If not specified, defaults to the number of CPU threads (found: {os.cpu_count()}).'
+    )
+    pool_parser.add_argument(
+        '--executor',
+        choices=EXECUTORS,
+        default='process',
+        help=
+        'Run workers as subprocesses, or as threads sharing the memory of the main process. Default: %(default)s'
     )
-    parser.add_argument('--chunksize',
-                        type=int,
-                        default=2,
-                        help='Chunksize for multiprocessing map operation. Default: %(default)s')
-    parser.add_argument(
+    pool_parser.add_argument(
+        '--chunksize',
+        type=int,
+        default=8,
+        help='Number of image paths sent to a worker at once. Default: %(default)s')
+    pool_parser.add_argument(
         '--resize',
         type=int,
         default=640,
         help=
         'Before computing descriptors, specifies the maximum length of the larger dimension when downscaling images. Default: %(default)s'
     )
-    parser.add_argument('query_img', type=Path, help='Path to the query image')
-    parser.add_argument('img_root',
-                        type=Path,
-                        help='Path to the directory containing images to search through')
-    args = parser.parse_args()
+    pool_parser.add_argument(
+        '--cache',
+        type=Path,
+        help='Directory of a persistent descriptor cache. Created if it does not exist.')
+    pool_parser.add_argument(
+        '--engine',
+        choices=tuple(ENGINES),
+        default='sift',
+        help=
+        'Keypoint descriptor engine. orb and akaze use binary descriptors matched with an LSH index, trading accuracy for speed. Default: %(default)s'
+    )
+    pool_parser.add_argument('--rootsift',
+                             action='store_true',
+                             help='Convert SIFT descriptors to RootSIFT.')
+    pool_parser.add_argument('--pca',
+                             type=Path,
+                             help='PCA basis file from "pca train" to reduce SIFT descriptors with.')
+    pool_parser.add_argument('--quantize',
+                             action='store_true',
+                             help='Store PCA-reduced descriptors as uint8. Requires --pca.')
+    pool_parser.add_argument(
+        '--full-decode',
+        action='store_true',
+        help='Always decode images at full resolution instead of reduced JPEG decoding.')
+    pool_parser.add_argument(
+        '--scan-threads',
+        type=int,
+        default=SCAN_THREADS,
+        help='Number of threads listing directories in parallel. Default: %(default)s')
+    pool_parser.add_argument(
+        '--sniff',
+        action='store_true',
+        help='Detect images by their magic bytes instead of their file extension.')
+    pool_parser.add_argument('--video',
+                             action='store_true',
+                             help='Also scan frames sampled from video files.')
+    pool_parser.add_argument(
+        '--frame-interval',
+        type=float,
+        default=VIDEO_FRAME_INTERVAL,
+        help='Seconds between frames sampled from videos. Default: %(default)s')
+    pool_parser.add_argument(
+        '--scene-threshold',
+        type=float,
+        help=
+        'Sample video frames on scene changes instead, when the mean absolute difference of consecutive thumbnails, from 0 to 1, is at least this value.'
+    )
+    pool_parser.add_argument(
+        '--segment-seconds',
+        type=float,
+        default=VIDEO_SEGMENT_SECONDS,
+        help='Length of the video segments scanned by one worker. Default: %(default)s')
+    pool_parser.add_argument(
+        '--stats-jsonl',
+        type=Path,
+        help='JSON Lines file to append the per-stage latency summary of every scan to.')
 
-    status_msg('Initializing workers...')
-    with multiprocessing.Pool(args.workers, init_worker, [args.query_img, args.resize]) as pool:
-        # filter(None, ...) means we use the identity function (e.g. lambda x: x) to filter.
-        # Since compute_ngood only returns None (on error) or a tuple (on success), this will filter out all None
-        all_matches = list(
-            filter(
-                None,
-                pool.imap_unordered(compute_ngood,
-                                    args.img_root.rglob('*'),
-                                    chunksize=args.chunksize)))
-    all_matches.sort()
-    info_msg(f'Top {NTOP} matches:', clear=True)
-    for ngood, scan_path in all_matches[-NTOP:]:
-        info_msg(scan_path, f'({ngood})')
+    # Options common to all commands that support the phash mode
+    hash_parser = argparse.ArgumentParser(add_help=False)
+    hash_parser.add_argument('--hash',
+                             choices=tuple(HASH_FUNCTIONS),
+                             default='phash',
+                             help='Perceptual hash function for phash mode. Default: %(default)s')
+    hash_parser.add_argument(
+        '--max-distance',
+        type=int,
+        default=HASH_MAX_DISTANCE,
+        help='Maximum Hamming distance between hashes of similar images in phash mode. Default: %(default)s')
+
+    # Options common to all commands that scan a directory with query images
+    scan_parser = argparse.ArgumentParser(add_help=False, parents=[pool_parser])
+    scan_parser.add_argument('query_imgs',
+                             type=Path,
+                             nargs='+',
+                             metavar='query_img',
+                             help='Path to a query image, or a directory of query images')
+    scan_parser.add_argument(
+        'img_root',
+        type=Path,
+        help=
+        'Path to the directory containing images to search through, or - to read NUL-separated paths from standard input'
+    )
+
+    search_parser = subparsers.add_parser('search',
+                                          parents=[scan_parser, hash_parser],
+                                          help='Search a directory for a similar image')
+    search_parser.add_argument(
+        '--mode',
+        choices=('sift', 'phash'),
+        default='sift',
+        help='sift matches keypoints; phash finds near duplicates by perceptual hash. Default: %(default)s')
+    search_parser.add_argument(
+        '--match-mode',
+        choices=MATCH_MODES,
+        default='pairwise',
+        help=
+        'pairwise trains a FLANN index per scanned image; indexed trains one on the query image per worker. Default: %(default)s'
+    )
+    search_parser.add_argument(
+        '--index',
+        type=Path,
+        help='Directory of a global index from "index build" to select candidates from.')
+    search_parser.add_argument(
+        '--candidates',
+        type=int,
+        default=VLAD_CANDIDATES,
+        help='Number of candidates per query image to select with --index. Default: %(default)s')
+    search_parser.add_argument(
+        '--cascade',
+        action='store_true',
+        help='Score all images at a small size first, and only the best of them at full size.')
+    search_parser.add_argument(
+        '--coarse-resize',
+        type=int,
+        default=CASCADE_MAX_LENGTH,
+        help='Maximum length of the larger dimension in the first pass of --cascade. Default: %(default)s')
+    search_parser.add_argument(
+        '--coarse-features',
+        type=int,
+        default=CASCADE_FEATURES,
+        help='Maximum number of keypoints per image in the first pass of --cascade. Default: %(default)s')
+    search_parser.add_argument(
+        '--refine',
+        type=int,
+        default=CASCADE_REFINE,
+        help='Number of images per query from the first pass of --cascade to score at full size. Default: %(default)s')
+    search_parser.add_argument(
+        '--ransac',
+        action='store_true',
+        help='Rank the top matches by the number of RANSAC homography inliers.')
+    search_parser.set_defaults(func=search)
+
+    dupes_parser = subparsers.add_parser('dupes',
+                                         parents=[pool_parser, hash_parser],
+                                         help='Print groups of similar images in a directory')
+    dupes_parser.add_argument(
+        '--mode',
+        choices=('phash', 'sift'),
+        default='phash',
+        help=
+        'phash groups near duplicates by perceptual hash; sift groups similar images by keypoint matches and needs --cache. Default: %(default)s'
+    )
+    dupes_parser.add_argument(
+        '--min-good',
+        type=int,
+        default=DUPES_MIN_GOOD,
+        help='Minimum number of good matches to group two images in sift mode. Default: %(default)s')
+    dupes_parser.add_argument(
+        '--shard-descriptors',
+        type=int,
+        default=DUPES_SHARD_DESCRIPTORS,
+        help='Maximum number of descriptors indexed at once in sift mode, which bounds memory use. Default: %(default)s')
+    dupes_parser.add_argument(
+        '--threads',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of threads matching images against the index in sift mode. Default: %(default)s')
+    dupes_parser.add_argument(
+        'img_root',
+        type=Path,
+        help='Path to the directory of images, or - to read NUL-separated paths from standard input')
+    dupes_parser.set_defaults(func=dupes)
+
+    bench_parser = subparsers.add_parser('bench', help='Compare speed and accuracy of options')
+    bench_subparsers = bench_parser.add_subparsers(required=True)
+    match_modes_parser = bench_subparsers.add_parser(
+        'match-modes',
+        parents=[scan_parser],
+        help='Compare the rankings and match time of all match modes')
+    match_modes_parser.set_defaults(func=bench_match_modes)
+    compact_bench_parser = bench_subparsers.add_parser(
+        'compact',
+        parents=[scan_parser],
+        help=
+        'Compare memory per image, match time and rankings of float32, RootSIFT and (with --pca) PCA descriptors'
+    )
+    compact_bench_parser.set_defaults(func=bench_compact)
+    executor_bench_parser = bench_subparsers.add_parser(
+        'executor',
+        parents=[scan_parser],
+        help='Compare throughput and peak memory of a search with every executor')
+    executor_bench_parser.add_argument(
+        '--match-mode',
+        choices=MATCH_MODES,
+        default='pairwise',
+        help='How scanned descriptors are matched against the query images. Default: %(default)s')
+    executor_bench_parser.set_defaults(func=bench_executor)
+    decode_parser = bench_subparsers.add_parser(
+        'decode',
+        parents=[pool_parser],
+        help='Compare decoding time per megapixel of full and reduced JPEG decoding')
+    decode_parser.add_argument('--limit',
+                               type=int,
+                               default=200,
+                               help='Maximum number of images to decode. Default: %(default)s')
+    decode_parser.add_argument(
+        'img_root',
+        type=Path,
+        help='Path to a directory of JPEG images, or - to read NUL-separated paths from standard input')
+    decode_parser.set_defaults(func=bench_decode)
+
+    index_parser = subparsers.add_parser('index', help='Maintain a global descriptor index')
+    index_subparsers = index_parser.add_subparsers(required=True)
+    build_parser = index_subparsers.add_parser(
+        'build',
+        parents=[pool_parser],
+        help='Build a VLAD index of all images in a directory. Using --cache is recommended')
+    build_parser.add_argument('--vocabulary-size',
+                              type=int,
+                              default=VLAD_VOCABULARY_SIZE,
+                              help='Number of visual words. Default: %(default)s')
+    build_parser.add_argument('--pca-dims',
+                              type=int,
+                              default=VLAD_PCA_DIMS,
+                              help='Number of dimensions of the index vectors. Default: %(default)s')
+    build_parser.add_argument(
+        'img_root',
+        type=Path,
+        help=
+        'Path to the directory of images to index, or - to read NUL-separated paths from standard input'
+    )
+    build_parser.add_argument('index_dir', type=Path, help='Path to the output index directory')
+    build_parser.set_defaults(func=index_build)
+
+    pca_parser = subparsers.add_parser('pca', help='Maintain PCA bases for compact descriptors')
+    pca_subparsers = pca_parser.add_subparsers(required=True)
+    pca_train_parser = pca_subparsers.add_parser(
+        'train', parents=[pool_parser], help='Train a PCA basis on descriptors of a directory')
+    pca_train_parser.add_argument('--dims',
+                                  type=int,
+                                  default=PCA_DIMS,
+                                  help='Number of dimensions to keep. Default: %(default)s')
+    pca_train_parser.add_argument(
+        'img_root',
+        type=Path,
+        help='Path to the directory of images, or - to read NUL-separated paths from standard input')
+    pca_train_parser.add_argument('basis_file', type=Path, help='Path to the output .npz file')
+    pca_train_parser.set_defaults(func=pca_train)
+
+    serve_parser = subparsers.add_parser(
+        'serve',
+        parents=[pool_parser],
+        help='Keep the descriptors of a directory in memory and answer queries over HTTP')
+    serve_parser.add_argument('--listen',
+                              default=SERVE_ADDRESS,
+                              help='HOST:PORT to listen on. Default: %(default)s')
+    serve_parser.add_argument('--unix', type=Path, help='Listen on this UNIX socket instead.')
+    serve_parser.add_argument(
+        '--threads',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of threads matching each query against the library. Default: %(default)s')
+    serve_parser.add_argument(
+        '--rescan-interval',
+        type=float,
+        default=SERVE_RESCAN_INTERVAL,
+        help='Seconds between rescans of img_root, or 0 to disable. Default: %(default)s')
+    serve_parser.add_argument('img_root', type=Path, help='Path to the directory of images')
+    serve_parser.set_defaults(func=serve)
+
+    cache_parser = subparsers.add_parser('cache', help='Maintain a persistent descriptor cache')
+    cache_subparsers = cache_parser.add_subparsers(required=True)
+    compact_parser = cache_subparsers.add_parser(
+        'compact', help='Remove entries of deleted or modified files and reclaim their space')
+    compact_parser.add_argument('cache_dir', type=Path, help='Path to the cache directory')
+    compact_parser.set_defaults(func=cache_compact)
+    invalidate_parser = cache_subparsers.add_parser(
+        'invalidate', help='Remove entries for the given files or directories')
+    invalidate_parser.add_argument('cache_dir', type=Path, help='Path to the cache directory')
+    invalidate_parser.add_argument('paths',
+                                   type=Path,
+                                   nargs='+',
+                                   help='Files or directories to invalidate')
+    invalidate_parser.set_defaults(func=cache_invalidate)
+
+    argv = sys.argv[1:]
+    # Before there were subcommands, the query image and the image root were given directly
+    if argv and argv[0] not in subparsers.choices and argv[0] not in ('-h', '--help'):
+        argv.insert(0, 'search')
+    args = parser.parse_args(argv)
+    args.func(args)
 
 
 if __name__ == '__main__':